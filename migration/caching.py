@@ -0,0 +1,82 @@
+import cPickle as pickle
+import os
+from copy import deepcopy
+from os.path import basename, exists, join
+from tempfile import mkstemp
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+LOG = logging.getLogger(basename(__file__))
+
+
+def get_catalog_fingerprint(connection):
+    """ Return a hash of the definitions of the tables, columns and
+    constraints of the public schema. It changes with the schema
+    """
+    with connection.cursor() as c:
+        c.execute("""
+SELECT md5(string_agg(definition, ';' ORDER BY definition))
+FROM (
+  SELECT 'table ' || relname || ' ' || relkind AS definition
+  FROM pg_class, pg_namespace
+  WHERE
+    pg_class.relnamespace = pg_namespace.oid AND
+    nspname = 'public'
+  UNION ALL
+  SELECT 'column ' || relname || '.' || attname || ' ' || attnum || ' '
+         || format_type(atttypid, atttypmod) || ' ' || attnotnull
+  FROM pg_attribute, pg_class, pg_namespace
+  WHERE
+    pg_attribute.attrelid = pg_class.oid AND
+    pg_class.relnamespace = pg_namespace.oid AND
+    nspname = 'public' AND
+    attnum > 0 AND
+    NOT attisdropped
+  UNION ALL
+  SELECT 'constraint ' || relname || '.' || conname || ' '
+         || pg_get_constraintdef(pg_constraint.oid)
+  FROM pg_constraint, pg_class, pg_namespace
+  WHERE
+    pg_constraint.conrelid = pg_class.oid AND
+    pg_class.relnamespace = pg_namespace.oid AND
+    nspname = 'public'
+) definitions;""")
+        return c.fetchone()[0]
+
+
+class SchemaCache(object):
+    """ Metadata computed from the schema of a database (dependencies,
+    foreign keys, columns, primary keys...), stored in a directory between
+    runs. The file is named after the fingerprint of the catalog, so the
+    metadata is reused until the schema changes, also by a copy
+    of the database
+    """
+    def __init__(self, directory, connection):
+        self.fingerprint = get_catalog_fingerprint(connection)
+        self.path = join(directory, self.fingerprint + '.pickle')
+        self.data = {}
+        if exists(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    self.data = pickle.load(f)
+                LOG.info(u'Using the schema cache %s', self.path)
+            except Exception, e:
+                LOG.warning(u'Ignoring the schema cache %s: %s', self.path, e)
+
+    def get(self, key, compute):
+        """ Return the value of the key, computed with compute() and stored
+        if it is missing. The value is a copy, which can be modified
+        """
+        if key not in self.data:
+            self.data[key] = compute()
+            self.save()
+        return deepcopy(self.data[key])
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if not exists(directory):
+            os.makedirs(directory)
+        fd, path = mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(self.data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(path, self.path)
@@ -0,0 +1,95 @@
+""" Manifest of the stages of a migration, stored in its directory, so that
+a failed migration can be resumed from its first incomplete stage
+"""
+import cPickle as pickle
+import hashlib
+import os
+from os.path import basename, exists, getsize, join
+from tempfile import mkstemp
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+LOG = logging.getLogger(basename(__file__))
+
+MANIFEST = 'manifest.pickle'
+
+
+def checksum(filepath):
+    """ Return the md5 of a file, read by blocks
+    """
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class Manifest(object):
+    """ The completed stages of a migration, in order, with the files each
+    stage leaves for the next ones and their checksums, and the data to
+    restore when resuming (processor state, imported tables...).
+    The manifest is rewritten after each change, so it survives a failure
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = join(directory, MANIFEST)
+        self.stages = []  # the completed stages, in order
+        self.files = {}  # {stage: {filename: (size, md5)}}
+        self.data = {}
+        if exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.stages, self.files, self.data = pickle.load(f)
+
+    def is_done(self, stage):
+        return stage in self.stages
+
+    def complete(self, stage, filepaths=()):
+        """ Record a stage as completed, with the files needed by the next stages
+        """
+        self.files[stage] = {basename(p): (getsize(p), checksum(p))
+                             for p in filepaths if exists(p)}
+        self.stages.append(stage)
+        self.save()
+        LOG.info(u'Completed the %s stage', stage)
+
+    def reset(self, stage):
+        """ Forget a completed stage and the following ones, so that they are
+        run again
+        """
+        if stage in self.stages:
+            index = self.stages.index(stage)
+            for forgotten in self.stages[index:]:
+                self.files.pop(forgotten, None)
+            del self.stages[index:]
+            self.save()
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.save()
+
+    def check(self):
+        """ Forget the last stages whose files are missing or modified, so that
+        they are run again, and return the stages still completed
+        """
+        while self.stages:
+            stage = self.stages[-1]
+            for filename, (size, md5) in sorted(self.files.get(stage, {}).items()):
+                filepath = join(self.directory, filename)
+                if not exists(filepath) or getsize(filepath) != size or checksum(filepath) != md5:
+                    LOG.warn(u'%s was modified, running the %s stage again', filename, stage)
+                    break
+            else:
+                break
+            self.stages.pop()
+            self.files.pop(stage, None)
+        self.save()
+        return list(self.stages)
+
+    def save(self):
+        fd, path = mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((self.stages, self.files, self.data), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(path, self.path)
@@ -7,10 +7,10 @@ LOG = logging.getLogger(basename(__file__))
 
 def add_related_tables(target_connection, tables,
                        excluded_tables, path=None,
-                       seen=None, related_tables=None, show_log=False):
+                       seen=None, related_tables=None, show_log=False, graph=None):
     res, related_tables = get_sql_dependencies(target_connection, tables,
                                                tables, tables, excluded_tables,
-                                               show_log=show_log)
+                                               show_log=show_log, graph=graph)
     res += related_tables
     return res, related_tables
 
@@ -26,9 +26,39 @@ def add_related_models(username, pwd, dbname, models,
     return res
 
 
+class DependencyGraph(object):
+    """ The foreign keys between the tables of a database, and the tables
+    having an id column, loaded at once from the catalog so that the
+    dependencies are computed in memory
+    """
+    def __init__(self, connection):
+        self.references = {}  # {table: set of tables it references}
+        self.referenced_by = {}  # {table: set of tables referencing it}
+        self.with_id = set()  # tables with an id column
+        with connection.cursor() as c:
+            c.execute("""
+SELECT DISTINCT pg_cl_1.relname, pg_cl_2.relname
+FROM pg_constraint, pg_class pg_cl_1, pg_class pg_cl_2
+WHERE pg_constraint.contype = 'f'
+  AND pg_constraint.conrelid = pg_cl_1.oid
+  AND pg_constraint.confrelid = pg_cl_2.oid
+  AND pg_cl_2.relkind = 'r';""")
+            for table, related_table in c.fetchall():
+                self.references.setdefault(table, set()).add(related_table)
+                self.referenced_by.setdefault(related_table, set()).add(table)
+            c.execute("""
+SELECT DISTINCT pg_class.relname
+FROM pg_attribute, pg_class
+WHERE pg_attribute.attrelid = pg_class.oid
+  AND pg_attribute.attname = 'id'
+  AND pg_attribute.attnum > 0
+  AND NOT pg_attribute.attisdropped;""")
+            self.with_id = set(row[0] for row in c.fetchall())
+
+
 def get_sql_dependencies(target_connection, tables, initial_tables,
                          real_tables, excluded_tables, path=None, seen=None,
-                         related_tables=None, show_log=False):
+                         related_tables=None, show_log=False, graph=None):
     """ Given a list of PSQL tables, return the full list of dependant tables,
     ordered by dependencies. Warning are displayed if there are dependency loops
     Set excluded_models to None if there is no table to exclude.
@@ -38,13 +68,16 @@ def get_sql_dependencies(target_connection, tables, initial_tables,
     - initial_tables represents the given psql tables list at first
     then add the real_tables already met
     - real_tables records table processed only if it had an id column
+    The foreign keys are read once in a DependencyGraph, which is walked
+    depth first with a stack of the tables being visited, so that the
+    dependencies of a table come before it and a loop is reported when a
+    table refers to one of the tables of the stack
     """
     res = []
+    if graph is None:
+        graph = DependencyGraph(target_connection)
     if seen is None:
         seen = set()
-    if path is None:
-        path = ()
-    real_tables = set(real_tables)
     if excluded_tables is not None:
         for excl_table in excluded_tables:
             seen.add(excl_table)
@@ -52,123 +85,91 @@ def get_sql_dependencies(target_connection, tables, initial_tables,
         excluded_tables = []
     if related_tables is None:
         related_tables = set()
-    for table in tables:
-        if table in seen:
+    # each level of the stack holds the tables to visit, the real tables and
+    # the path known at this level, and the table being visited with its
+    # related tables not visited yet
+    stack = [[iter(tables), set(real_tables), path or (), None]]
+    while stack:
+        level = stack[-1]
+        tables_left, real_tables, path, visiting = level
+        if visiting is None:
+            table = next(tables_left, None)
+            if table is None:
+                stack.pop()
+            elif table not in seen:
+                level[3] = (table, iter(_visit_table(
+                    graph, table, initial_tables, real_tables, excluded_tables,
+                    path, seen, related_tables, show_log)))
             continue
-        with target_connection.cursor() as c:
-            m2o = set()
-            m2m = set()
-            seen.add(table)
-            query_fk = """
-  SELECT DISTINCT pg_cl_2.relname as related_table
-  FROM pg_class pg_cl_1, pg_class pg_cl_2, pg_constraint,
-  pg_attribute pg_attr_1,
-  pg_attribute pg_attr_2 WHERE pg_cl_1.relname = '%s'
-  and pg_constraint.conrelid = pg_cl_1.oid
-  AND pg_cl_2.relkind = 'r' AND pg_cl_2.oid = pg_constraint.confrelid
-  AND pg_attr_1.attnum = pg_constraint.confkey[1]
-  AND pg_attr_1.attrelid = pg_cl_2.oid
-  AND pg_attr_2.attnum = pg_constraint.conkey[1]
-  AND pg_attr_2.attrelid = pg_cl_1.oid;
-  """ % table
-
-            query_table_ref = """
-  SELECT tc.table_name
-  FROM information_schema.table_constraints AS tc JOIN
-  information_schema.key_column_usage AS kcu ON
-  tc.constraint_name = kcu.constraint_name JOIN
-  information_schema.constraint_column_usage AS
-  ccu ON ccu.constraint_name = tc.constraint_name
-  WHERE constraint_type = 'FOREIGN KEY' AND
-  ccu.table_name='%s';""" % table
-
-            c.execute(query_fk)
-            foreign_keys = c.fetchall()
-
-            if table in real_tables:
-                if foreign_keys:
-                    for foreign_key in foreign_keys:
-                        tbl = foreign_key[0]
-                        if tbl in path:
-                            show_log and LOG.warn('Dependency LOOP: '
-                                     '%s has a m2o to %s which is one of its '
-                                     'ancestors (path=%r)',
-                                     table, tbl, path)
-                        if tbl not in seen:
-                            m2o.add(tbl)
-                c.execute(query_table_ref)
-                results_ref = c.fetchall()
-                diff_tables = set(results_ref).difference(set(foreign_keys))
-                for t in diff_tables:
-                    tbl = t[0]
-                    query_third_tables = """
-SELECT column_name
-FROM INFORMATION_SCHEMA.COLUMNS
-WHERE TABLE_NAME = '%s';""" % tbl
-                    c.execute(query_third_tables)
-                    columns = c.fetchall()
-                    columns_list = []
-                    if columns:
-                        for item in columns:
-                            columns_list.append(item[0])
-                        columns_set = set(columns_list)
-                        if 'id' in columns_set:
-                            real_tables.add(tbl)
-                            continue
-                        if tbl not in seen:
-                            if tbl not in related_tables:
-                                if tbl in path:
-                                    LOG.warn('Dependency LOOP: '
-                                             '%s has a m2m to %s which is one of'
-                                             'its ancestors (path=%r)',
-                                             table, tbl, path)
-                                if tbl not in m2m:
-                                    m2m.add(tbl)
-            else:
-                if foreign_keys:
-                    to_import = True
-                    for foreign_key in foreign_keys:
-                        tbl = foreign_key[0]
-                        if tbl not in initial_tables:
-                            to_import = False
-                    if to_import:
-                        related_tables.add(table)
-                    elif not to_import:
-                        excluded_tables.append(table)
-
-        if (table not in related_tables
-                and table not in excluded_tables
-                and table not in initial_tables):
-            initial_tables.append(table)
-        for t in m2o:
+        table, related = visiting
+        t = next(related, None)
+        if t is None:
+            # all the related tables of the table are visited
+            if table not in related_tables and table not in excluded_tables:
+                res.append(table)
+            level[3] = None
+            continue
+        t, is_m2o = t
+        if is_m2o:
             real_tables.add(t)
-            results, related_tables = get_sql_dependencies(target_connection,
-                                                           (t,),
-                                                           initial_tables,
-                                                           real_tables,
-                                                           path=path+(table,),
-                                                           excluded_tables=excluded_tables,
-                                                           seen=seen,
-                                                           related_tables=related_tables,
-                                                           show_log=show_log)
-            res += results
-        for t in m2m:
-            results, related_tables = get_sql_dependencies(target_connection,
-                                                           (t,),
-                                                           initial_tables,
-                                                           real_tables,
-                                                           path=path+(table,),
-                                                           excluded_tables=excluded_tables,
-                                                           seen=seen,
-                                                           related_tables=related_tables,
-                                                           show_log=show_log)
-            res += results
-
-        if table not in related_tables and table not in excluded_tables:
-            res.append(table)
+        stack.append([iter((t,)), set(real_tables), path + (table,), None])
     return res, related_tables
 
 
+def _visit_table(graph, table, initial_tables, real_tables, excluded_tables,
+                 path, seen, related_tables, show_log):
+    """ Mark a table as seen for get_sql_dependencies and return its related
+    tables to visit, as (table, is_m2o) tuples
+    """
+    m2o = set()
+    m2m = set()
+    seen.add(table)
+    foreign_keys = graph.references.get(table, set())
+
+    if table in real_tables:
+        for tbl in foreign_keys:
+            if tbl in path:
+                show_log and LOG.warn('Dependency LOOP: '
+                         '%s has a m2o to %s which is one of its '
+                         'ancestors (path=%r)',
+                         table, tbl, path)
+            if tbl not in seen:
+                m2o.add(tbl)
+        diff_tables = graph.referenced_by.get(table, set()).difference(foreign_keys)
+        for tbl in diff_tables:
+            if tbl in graph.with_id:
+                real_tables.add(tbl)
+                continue
+            if tbl not in seen:
+                if tbl not in related_tables:
+                    if tbl in path:
+                        LOG.warn('Dependency LOOP: '
+                                 '%s has a m2m to %s which is one of'
+                                 'its ancestors (path=%r)',
+                                 table, tbl, path)
+                    if tbl not in m2m:
+                        m2m.add(tbl)
+    else:
+        if foreign_keys:
+            to_import = True
+            for tbl in foreign_keys:
+                if tbl not in initial_tables:
+                    to_import = False
+            if to_import:
+                related_tables.add(table)
+            elif not to_import:
+                excluded_tables.append(table)
+
+    if (table not in related_tables
+            and table not in excluded_tables
+            and table not in initial_tables):
+        initial_tables.append(table)
+    # visit the related tables in a stable order, since m2m tables
+    # are kept or excluded depending on the tables already met
+    return ([(t, True) for t in sorted(m2o)]
+            + [(t, False) for t in sorted(m2m)])
+
+
 def get_dependencies(username, pwd, dbname, models, excluded_models,
                      path=None, seen=None, related_tables=None):
     """ Given a list of OpenERP models, return the full list of dependant models,
@@ -245,34 +246,136 @@ def get_dependencies(username, pwd, dbname, models, excluded_models,
 def get_fk_to_update(connection, tables):
     """ Method to get back all columns referencing another table
     """
-    fk2update = {}
+    return {fk: pointed_table for fk, (pointed_table, _)
+            in get_foreign_keys(connection, tables).iteritems()}
+
+
+def get_foreign_keys(connection, tables):
+    """ Return the foreign keys pointing to the tables, with whether their
+    column is NOT NULL: {'table.column': (pointed_table, not_null)}.
+    All the foreign keys pointing to the tables are read in a single query.
+    Only the columns pointing to the id of a table are foreign keys to update,
+    the other columns of a multi-column constraint are kept
+    """
+    tables = ['ir.actions.actions' if t == 'ir.actions' else t for t in tables]
+    if not tables:
+        return {}
     with connection.cursor() as c:
-        for table in tables:
-            if table not in fk2update:
-                if table == 'ir.actions':
-                    table = 'ir.actions.actions'
-                query = """
-SELECT tc.table_name, kcu.column_name
-FROM information_schema.table_constraints AS tc JOIN
-information_schema.key_column_usage AS kcu ON
-tc.constraint_name = kcu.constraint_name JOIN
-information_schema.constraint_column_usage AS
-ccu ON ccu.constraint_name = tc.constraint_name
-WHERE constraint_type = 'FOREIGN KEY' AND
-ccu.table_name='%s';""" % table
-                c.execute(query)
-                results = c.fetchall()
-                fk2update[table] = results
-    # transpose the result to obtain:
-    # {'table.fkname': 'pointed_table', ...}
+        c.execute("""
+SELECT pg_cl_1.relname, pg_att_1.attname, pg_cl_2.relname, pg_att_1.attnotnull
+FROM (SELECT conrelid, confrelid, conkey, confkey,
+             generate_subscripts(conkey, 1) AS i
+      FROM pg_constraint
+      WHERE contype = 'f') AS fk,
+     pg_class pg_cl_1, pg_class pg_cl_2, pg_attribute pg_att_1, pg_attribute pg_att_2
+WHERE fk.conrelid = pg_cl_1.oid
+  AND fk.confrelid = pg_cl_2.oid
+  AND pg_cl_2.relname IN %s
+  AND pg_att_1.attrelid = fk.conrelid
+  AND pg_att_1.attnum = fk.conkey[fk.i]
+  AND pg_att_2.attrelid = fk.confrelid
+  AND pg_att_2.attnum = fk.confkey[fk.i]
+  AND pg_att_2.attname = 'id';""", (tuple(tables),))
+        results = c.fetchall()
+    # build the result as:
+    # {'table.fkname': ('pointed_table', not_null), ...}
     # so that processing each input line is easier
     result = {}
-    for pointed_table, fknames in fk2update.iteritems():
-        for fkname in fknames:
-            result['.'.join(fkname)] = pointed_table
+    for table, column, pointed_table, not_null in results:
+        result[table + '.' + column] = (pointed_table, not_null)
     return result
 
 
+def get_self_references(foreign_keys, deferred=None):
+    """ Return the set of tables with a foreign key to themselves which is
+    not deferred: their rows must be imported in a single COPY
+    """
+    deferred = deferred or {}
+    tables = set()
+    for fk, pointed_table in foreign_keys.iteritems():
+        table, column = fk.split('.', 1)
+        if table == pointed_table and column not in deferred.get(table, ()):
+            tables.add(table)
+    return tables
+
+
+def get_import_levels(tables, foreign_keys, deferred=None, not_null=()):
+    """ Group the tables in levels which can be imported one after the
+    other, the tables of a level being imported in parallel with the foreign
+    key constraints enabled: a table only references tables of the previous
+    levels, or itself, as the constraints are checked at the end of the COPY.
+    foreign_keys is {'table.column': 'pointed_table'}, see get_fk_to_update,
+    and the deferred columns {table: set of columns} are ignored, as they
+    are updated after the import.
+    The cycles are broken by deferring the foreign keys of a table of the
+    cycle. The foreign keys given in not_null {'table.column'} can't be
+    deferred, and the columns deferred by the mapping for other tables, such
+    as create_uid, are deferred first. Return the levels and the columns to
+    defer {table: set of columns}, or raise a ValueError if a cycle only has
+    NOT NULL foreign keys
+    """
+    tables = set(tables)
+    deferred = deferred or {}
+    # the names of the columns the mapping already defers
+    preferred = set(c for columns in deferred.itervalues() for c in columns)
+    references = {}  # {table: {column: pointed_table}}
+    for fk, pointed_table in foreign_keys.iteritems():
+        table, column = fk.split('.', 1)
+        if (table in tables and pointed_table in tables and table != pointed_table
+                and column not in deferred.get(table, ())):
+            references.setdefault(table, {})[column] = pointed_table
+    levels, to_defer = [], {}
+    remaining, imported = set(tables), set()
+    while remaining:
+        level = [t for t in remaining
+                 if all(p in imported for p in references.get(t, {}).values())]
+        if not level:
+            # a cycle: defer the nullable fks of a table of a cycle which only
+            # depends on its own cycle, preferring the columns deferred by the
+            # mapping, then the table which is the most referenced by the others
+            def pending(table):
+                return sorted(c for c, p in references.get(table, {}).iteritems()
+                              if p in remaining)
+            reach = {}
+            for table in remaining:
+                seen, stack = set(), [table]
+                while stack:
+                    for pointed in references.get(stack.pop(), {}).values():
+                        if pointed in remaining and pointed not in seen:
+                            seen.add(pointed)
+                            stack.append(pointed)
+                reach[table] = seen
+            cycle = [t for t in remaining
+                     if t in reach[t] and all(t in reach[u] for u in reach[t])]
+            candidates = [t for t in cycle
+                          if not any(t + '.' + c in not_null for c in pending(t))]
+            if not candidates:
+                # every table of the cycle has a NOT NULL fk in the cycle
+                cycle = sorted(reach[min(cycle)])
+                raise ValueError(
+                    u'The foreign keys between %s form a cycle which can not be '
+                    u'deferred, as their columns are NOT NULL:\n%s' % (
+                        ', '.join(cycle),
+                        '\n'.join(t + '.' + c for t in cycle for c in pending(t)
+                                  if t + '.' + c in not_null
+                                  and references[t][c] in cycle)))
+
+            def score(table):
+                referenced = sum(1 for u in remaining if u != table
+                                 for p in references.get(u, {}).values() if p == table)
+                return (len([c for c in pending(table) if c not in preferred]),
+                        len(pending(table)) - referenced, table)
+            table = min(candidates, key=score)
+            LOG.info(u'Deferring %s to break a cycle of foreign keys',
+                     ', '.join(table + '.' + c for c in pending(table)))
+            to_defer.setdefault(table, set()).update(pending(table))
+            level = [table]
+        levels.append(sorted(level))
+        imported.update(level)
+        remaining.difference_update(level)
+    return levels, to_defer
+
+
 def get_mapping_migration(username_from, username_to, pwd_from, pwd_to,
                           dbname_from, dbname_to, model):
     """ Method to define which record needs to be update or not before importing it
@@ -1,4 +1,5 @@
-from os.path import join
+from os.path import join, getsize
+import os
 import psycopg2.extras
 import logging
 from os.path import basename
@@ -8,22 +9,151 @@ LOG = logging.getLogger(basename(__file__))
 from multiprocessing import Pool
 from functools import partial
 
-from .sql_commands import get_db_connection
+from . import pgbinary
+from .sql_commands import get_db_connection, export_snapshot, set_snapshot
+from .sql_commands import get_table_sizes, get_column_types
 
+BLOCK_SIZE = 8192  # size of the pages of postgresql
 
-def __export_to_csv(table, dsn=None, dest_dir=None):
+
+def __export_to_csv(task, dsn=None, dest_dir=None, header_only=False, binary=False,
+                    snapshot=None):
+    """ Export a task (table, part, where): a whole table if part is None,
+    otherwise the rows matching the where clause in a numbered part file.
+    Only the first part of a csv export has the header
+    """
+    table, part, where = task
     with get_db_connection(dsn=dsn) as connection:
-        filename = join(dest_dir, table + '.csv')
-        with connection.cursor() as cursor, open(filename, 'w') as f:
-            cursor.copy_expert("""COPY "%s" TO STDOUT WITH CSV HEADER NULL ''""" % table, f)
+        if header_only:
+            source = '(SELECT * FROM "%s" LIMIT 0)' % table
+        elif where:
+            source = '(SELECT * FROM "%s" WHERE %s)' % (table, where)
+        else:
+            source = '"%s"' % table
+        if binary:
+            filename = join(dest_dir, table + '.bin')
+            copy = 'COPY %s TO STDOUT WITH BINARY' % source
+        else:
+            filename = join(dest_dir, table + '.csv')
+            header = ' ' if part else ' HEADER '
+            copy = """COPY %s TO STDOUT WITH CSV%sNULL ''""" % (source, header)
+        if part is not None:
+            filename = '%s.%s' % (filename, part)
+        with connection.cursor() as cursor, open(filename, 'wb') as f:
+            if snapshot:
+                set_snapshot(cursor, snapshot)
+            cursor.copy_expert(copy, f)
     return filename
 
 
-def export_to_csv(tables, dest_dir, connection):
+def get_id_ranges(connection, table, parts):
+    """ Return the where clauses splitting a table in parts of equal ranges
+    of ids, see split_ids
+    """
+    with connection.cursor() as c:
+        c.execute('SELECT min(id), max(id) FROM "%s"' % table)
+        min_id, max_id = c.fetchone()
+    return split_ids(min_id, max_id, parts)
+
+
+def split_ids(min_id, max_id, parts):
+    """ Return the where clauses splitting the ids from min_id to max_id in
+    at most parts ranges of equal size, or no clause if they can't be split.
+    The first and last ranges are open, so that no row is missed whatever
+    the snapshot of the connection
+    """
+    if min_id is None:
+        return []
+    parts = min(parts, max_id - min_id + 1)
+    bounds = [min_id + (max_id - min_id + 1) * i // parts for i in range(1, parts)]
+    if not bounds:
+        return []
+    wheres = ['id < %d' % bounds[0]]
+    wheres += ['id >= %d AND id < %d' % (a, b) for a, b in zip(bounds, bounds[1:])]
+    wheres.append('id >= %d OR id IS NULL' % bounds[-1])
+    return wheres
+
+
+def stitch_parts(filename, parts, binary=False):
+    """ Concatenate the part files of a table in its file, and remove them.
+    Each part of a binary export has the header and the trailer of the format,
+    only the first header and the last trailer are kept
+    """
+    with open(filename, 'wb') as f:
+        for part in range(parts):
+            part_filename = '%s.%s' % (filename, part)
+            size = getsize(part_filename)
+            with open(part_filename, 'rb') as part_file:
+                if binary and part > 0:
+                    part_file.seek(len(pgbinary.HEADER))
+                    size -= len(pgbinary.HEADER)
+                if binary and part < parts - 1:
+                    size -= len(pgbinary.TRAILER)
+                while size > 0:
+                    data = part_file.read(min(size, 1048576))
+                    if not data:
+                        break
+                    f.write(data)
+                    size -= len(data)
+            os.remove(part_filename)
+
+
+def export_to_csv(tables, dest_dir, connection, header_only=False, binary=False,
+                  snapshot=None, part_size=None, filters=None):
     """ Export data using postgresql COPY
+    With header_only, only the header of the csv files is exported
+    With binary, the data is exported in .bin files with the binary format
+    of COPY, in the order of the columns of the csv header (see pgbinary.py)
+    The tables are exported in parallel, the biggest ones first, and all
+    from the given snapshot (see export_snapshot), or from a snapshot
+    exported for the duration of the export, so that they are consistent.
+    The tables with an integer id bigger than part_size bytes are exported
+    in ranges of ids by several connections, then stitched in a single file.
+    filters is {table: where clause}, to export only some rows of the tables
     """
+    snapshot_connection = None
+    filters = filters or {}
+    tasks = [(t, None, filters.get(t)) for t in tables]
+    parts = {}  # {table: number of parts}
+    if not header_only:
+        if snapshot is None:
+            snapshot_connection = get_db_connection(dsn=connection.dsn)
+            snapshot = export_snapshot(snapshot_connection)
+        sizes = {t: pages * BLOCK_SIZE for t, pages in
+                 get_table_sizes(connection, tables).iteritems()}
+        big_tables = [t for t in tables if part_size and sizes.get(t, 0) > part_size]
+        types = get_column_types(connection, big_tables)
+        for table in big_tables:
+            if types.get(table, {}).get('id') not in pgbinary.INTEGERS:
+                continue
+            wheres = get_id_ranges(connection, table, -(-sizes[table] // part_size))
+            if wheres:
+                LOG.info(u'Exporting %s in %s parts', table, len(wheres))
+                parts[table] = len(wheres)
+                sizes[table] //= len(wheres)
+                tasks.remove((table, None, filters.get(table)))
+                if table in filters:
+                    wheres = ['(%s) AND (%s)' % (w, filters[table]) for w in wheres]
+                tasks += [(table, i, where) for i, where in enumerate(wheres)]
+        tasks.sort(key=lambda task: sizes.get(task[0], 0), reverse=True)
     p = Pool(8)
-    return p.map(partial(__export_to_csv, dsn=connection.dsn, dest_dir=dest_dir), tables)
+    try:
+        filenames = p.map(partial(__export_to_csv, dsn=connection.dsn, dest_dir=dest_dir,
+                                  header_only=header_only, binary=binary,
+                                  snapshot=snapshot),
+                          tasks, 1)
+    finally:
+        p.close()
+        p.join()
+        if snapshot_connection is not None:
+            snapshot_connection.close()
+    filenames = {table: filename for (table, part, _), filename in zip(tasks, filenames)
+                 if part is None}
+    for table, count in parts.iteritems():
+        filenames[table] = join(dest_dir, table + (binary and '.bin' or '.csv'))
+        stitch_parts(filenames[table], count, binary)
+    # in the order of the tables
+    return [filenames[t] for t in tables]
 
 
 def extract_existing(tables, m2m_tables, discriminators, connection):
@@ -0,0 +1,349 @@
+""" Compact storage for the mappings between source and target ids
+"""
+import mmap
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from heapq import merge
+from itertools import izip
+from tempfile import mkstemp
+
+# signed longs, which are 64 bit integers on 64 bit unix systems
+# (the 'q' typecode doesn't exist in python 2)
+TYPECODE = 'l'
+MISSING = -2 ** (8 * array(TYPECODE).itemsize - 1)  # marks the holes of a dense IdMap
+
+
+class IdMap(object):
+    """ A mapping between integer ids, with the dict methods used for the
+    fk mapping. A dict of ints costs more than 100 bytes per entry, so the
+    ids are stored in arrays of machine integers: either sorted keys and
+    values found by bisection, or, when the keys are dense, only the values
+    indexed by key - base. New ids go to a dict buffer which is merged
+    in the arrays when it grows bigger than buffer_size
+    """
+    def __init__(self, items=(), buffer_size=65536):
+        self.keys = array(TYPECODE)
+        self.values = array(TYPECODE)
+        self.base = None  # first key of a dense map
+        self.size = 0  # number of ids in the arrays
+        self.buffer = {}
+        self.buffer_size = buffer_size
+        self.update(items)
+
+    def find(self, key):
+        """ Return the index of the value of a key in the arrays, or -1
+        """
+        values = self.values
+        if self.base is not None:
+            i = key - self.base
+            if 0 <= i < len(values) and values[i] != MISSING:
+                return i
+            return -1
+        keys = self.keys
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return i
+        return -1
+
+    def get(self, key, default=None):
+        value = self.buffer.get(key)
+        if value is not None:
+            return value
+        i = self.find(key)
+        return default if i < 0 else self.values[i]
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        i = self.find(key)
+        if i >= 0:
+            self.values[i] = value
+            return
+        self.buffer[key] = value
+        if len(self.buffer) > self.buffer_size:
+            self.compact()
+
+    def __contains__(self, key):
+        return key in self.buffer or self.find(key) >= 0
+
+    def __len__(self):
+        return self.size + len(self.buffer)
+
+    def __iter__(self):
+        for key, _ in self.iteritems():
+            yield key
+
+    def iteritems(self):
+        for item in self.iter_arrays():
+            yield item
+        for item in self.buffer.iteritems():
+            yield item
+
+    def iter_arrays(self):
+        """ Iterate the ids stored in the arrays, sorted by key
+        """
+        if self.base is not None:
+            for i, value in enumerate(self.values):
+                if value != MISSING:
+                    yield self.base + i, value
+        else:
+            for item in izip(self.keys, self.values):
+                yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    def update(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        for key, value in items:
+            self[key] = value
+
+    def compact(self):
+        """ Merge the buffer in the arrays, and choose the dense storage
+        if it takes less memory than the sorted keys and values
+        """
+        if not self.buffer:
+            return
+        # the keys of the buffer are never in the arrays
+        buffered = sorted(self.buffer.iteritems())
+        self.buffer = {}
+        keys, values = array(TYPECODE), array(TYPECODE)
+        for key, value in merge(self.iter_arrays(), buffered):
+            keys.append(key)
+            values.append(value)
+        self.size = len(keys)
+        if keys[-1] - keys[0] < 2 * len(keys):
+            self.base = keys[0]
+            self.keys = array(TYPECODE)
+            self.values = array(TYPECODE, [MISSING]) * (keys[-1] - keys[0] + 1)
+            for key, value in izip(keys, values):
+                self.values[key - self.base] = value
+        else:
+            self.base = None
+            self.keys, self.values = keys, values
+
+    def __repr__(self):
+        return 'IdMap(%r)' % dict(self.iteritems())
+
+
+PAGE_SIZE = 4096  # number of ids in a page of a DiskIdMap
+
+
+class PageCache(object):
+    """ LRU cache of the pages of the DiskIdMaps. It is shared by all the
+    tables so that the pages of the most used tables stay in memory
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = capacity  # number of pages
+        self.pages = OrderedDict()
+
+    def get(self, key, load):
+        """ Return the page of a key, loaded with load() if not cached
+        """
+        try:
+            page = self.pages.pop(key)
+        except KeyError:
+            page = load()
+            while len(self.pages) >= self.capacity:
+                self.pages.popitem(last=False)
+        self.pages[key] = page
+        return page
+
+    def discard(self, path):
+        """ Forget the pages of a file
+        """
+        for key in [k for k in self.pages if k[0] == path]:
+            del self.pages[key]
+
+
+CACHE = PageCache()
+
+
+def set_cache_size(size):
+    """ Set the size in bytes of the page cache of the DiskIdMaps
+    """
+    CACHE.capacity = max(1, size // (2 * PAGE_SIZE * array(TYPECODE).itemsize))
+
+
+class DiskIdMap(object):
+    """ A mapping between integer ids, like IdMap, for the mappings which
+    don't fit in memory. The ids are stored sorted in a file of the given
+    directory, in pages of PAGE_SIZE keys followed by their values. The file
+    is memory-mapped, and the pages are read through the LRU page cache.
+    The first key of each page is kept in memory to find the page of a key.
+    New ids go to a dict buffer which is merged with the file in a new
+    file when it grows bigger than buffer_size
+    """
+    def __init__(self, directory, items=(), buffer_size=65536):
+        self.directory = directory
+        self.path = None
+        self.pid = None  # the process which created the file
+        self.file = None
+        self.first_keys = array(TYPECODE)
+        self.size = 0  # number of ids in the file
+        self.buffer = {}  # overrides the ids of the file
+        self.buffer_size = buffer_size
+        self.update(items)
+
+    def read_page(self, number):
+        """ Read the keys and values of a page of the file
+        """
+        itemsize = self.first_keys.itemsize
+        count = min(PAGE_SIZE, self.size - number * PAGE_SIZE)
+        start = number * PAGE_SIZE * 2 * itemsize
+        keys, values = array(TYPECODE), array(TYPECODE)
+        keys.fromstring(self.file[start:start + count * itemsize])
+        values.fromstring(self.file[start + count * itemsize:start + 2 * count * itemsize])
+        return keys, values
+
+    def page(self, number):
+        """ Return the keys and values of a page, through the page cache
+        """
+        return CACHE.get((self.path, number), lambda: self.read_page(number))
+
+    def get_stored(self, key):
+        """ Return the value of a key in the file, or None
+        """
+        number = bisect_right(self.first_keys, key) - 1
+        if number < 0:
+            return None
+        keys, values = self.page(number)
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return values[i]
+        return None
+
+    def get(self, key, default=None):
+        value = self.buffer.get(key)
+        if value is None:
+            value = self.get_stored(key)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.buffer[key] = value
+        if len(self.buffer) > self.buffer_size:
+            self.compact()
+
+    def __contains__(self, key):
+        return key in self.buffer or self.get_stored(key) is not None
+
+    def __len__(self):
+        return self.size + len([k for k in self.buffer if self.get_stored(k) is None])
+
+    def __iter__(self):
+        for key, _ in self.iteritems():
+            yield key
+
+    def iteritems(self):
+        for key, value in self.iter_stored():
+            if key not in self.buffer:
+                yield key, value
+        for item in self.buffer.iteritems():
+            yield item
+
+    def iter_stored(self):
+        """ Iterate the ids of the file, sorted by key, without the page cache
+        """
+        for number in xrange(len(self.first_keys)):
+            for item in izip(*self.read_page(number)):
+                yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    def update(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        for key, value in items:
+            self[key] = value
+
+    def compact(self):
+        """ Merge the buffer and the file in a new file
+        """
+        if not self.buffer:
+            return
+        buffered = sorted(self.buffer.iteritems())
+        stored = ((k, v) for k, v in self.iter_stored() if k not in self.buffer)
+        fd, path = mkstemp(suffix='.ids', dir=self.directory)
+        first_keys, size = array(TYPECODE), 0
+        with os.fdopen(fd, 'wb') as f:
+            keys, values = array(TYPECODE), array(TYPECODE)
+            for key, value in merge(stored, buffered):
+                keys.append(key)
+                values.append(value)
+                if len(keys) == PAGE_SIZE:
+                    first_keys.append(keys[0])
+                    f.write(keys.tostring() + values.tostring())
+                    size += len(keys)
+                    keys, values = array(TYPECODE), array(TYPECODE)
+            if keys:
+                first_keys.append(keys[0])
+                f.write(keys.tostring() + values.tostring())
+                size += len(keys)
+        self.close()
+        self.path, self.pid = path, os.getpid()
+        self.first_keys, self.size, self.buffer = first_keys, size, {}
+        self.open()
+
+    def freeze(self, path):
+        """ Return a copy of the map stored in a hard link of its file at path,
+        which is kept when the map changes and isn't removed when the copy is
+        closed, so that the copy can be pickled and loaded by another process
+        """
+        self.compact()
+        frozen = DiskIdMap(self.directory, buffer_size=self.buffer_size)
+        if os.path.exists(path):
+            os.remove(path)
+        if self.path is not None:
+            os.link(self.path, path)
+            frozen.path = path
+            frozen.first_keys, frozen.size = array(TYPECODE, self.first_keys), self.size
+            frozen.open()
+        return frozen
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            self.file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        """ Close the file, and remove it if it was created by this process:
+        the maps inherited by the worker processes share the files of the parent.
+        The files of the maps returned by the workers are left to the owner of
+        the directory (see migrating.migrate)
+        """
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        CACHE.discard(self.path)
+        if self.pid == os.getpid():
+            os.remove(self.path)
+
+    def __getstate__(self):
+        """ Only the path of the file is pickled, with the buffer merged in it
+        """
+        self.compact()
+        state = self.__dict__.copy()
+        state['file'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.open()
+
+    def __repr__(self):
+        return 'DiskIdMap(%r)' % dict(self.iteritems())
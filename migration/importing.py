@@ -1,26 +1,98 @@
-from os.path import basename, exists, getsize
+from os.path import basename, exists, getsize, splitext
 from os import rename
 import csv
 from multiprocessing import Pool
 from functools import partial
 
-from .sql_commands import make_savepoint, get_db_connection
+from .sql_commands import make_savepoint, get_db_connection, drop_indexes
+from .sql_commands import setup_temp_table, drop_temp_table
+from .processing import split_csv
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
 LOG = logging.getLogger(basename(__file__))
 
 
-def __run_fast_import(filepath, dsn=None, suffix=""):
-    table = basename(filepath).rsplit('.', 2)[0] + suffix
-    with get_db_connection(dsn=dsn) as connection:
-        with open(filepath) as f, connection.cursor() as c:
-            columns = ','.join(['"%s"' % col for col in csv.reader(f).next()])
-            f.seek(0)
-            copy = ("COPY %s (%s) FROM STDOUT WITH CSV HEADER NULL ''"
-                    % (table, columns))
-            c.copy_expert(copy, f)
-        LOG.info(u"SUCCESS importing %s" % table)
+class FileRange(object):
+    """ A file object reading only the (start, end) byte range of a file
+    """
+    def __init__(self, f, start, end):
+        f.seek(start)
+        self.f = f
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def read_columns(filepath):
+    """ Return the columns of a csv file, or of the .csv file with the same
+    name for a .bin file
+    """
+    if filepath.endswith('.bin'):
+        filepath = splitext(filepath)[0] + '.csv'
+    with open(filepath) as f:
+        return csv.reader(f).next()
+
+
+def copy_from_file(cursor, table, filepath, chunk=None):
+    """ COPY a csv file in a table, or only the (start, end) byte range of a
+    chunk of its rows (see processing.split_csv). A .bin file is in the
+    binary format of COPY, and its columns are those of the header of the
+    .csv file with the same name (see CSVProcessor.process_binary)
+    """
+    columns = ','.join(['"%s"' % col for col in read_columns(filepath)])
+    if filepath.endswith('.bin'):
+        copy = "COPY %s (%s) FROM STDOUT WITH BINARY" % (table, columns)
+    else:
+        copy = ("COPY %s (%s) FROM STDOUT WITH CSV%sNULL ''"
+                % (table, columns, ' ' if chunk else ' HEADER '))
+    with open(filepath, 'rb') as f:
+        cursor.copy_expert(copy, f if chunk is None else FileRange(f, *chunk))
+
+
+def upsert_from_file(cursor, table, filepath, chunk=None, pkey=None):
+    """ Import a file like copy_from_file, but through a temp table, so that
+    the rows already in the table are updated instead of failing the import.
+    Without primary key, the rows already in the table are left untouched
+    """
+    columns = read_columns(filepath)
+    setup_temp_table(cursor, table, '_upsert', {table: pkey}, columns)
+    copy_from_file(cursor, table + '_upsert', filepath, chunk)
+    quoted = ','.join('"%s"' % col for col in columns)
+    if pkey and pkey in columns:
+        conflict = '("%s") DO UPDATE SET %s' % (pkey, ','.join(
+            '"%s"=EXCLUDED."%s"' % (col, col) for col in columns if col != pkey))
+    else:
+        conflict = 'DO NOTHING'
+    cursor.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {0}_upsert ON CONFLICT {2}'
+                   .format(table, quoted, conflict))
+    drop_temp_table(cursor, table, '_upsert')
+
+
+def __run_fast_import(task, dsn=None, suffix="", primary_keys=None):
+    """ Import the files of a table in a single transaction, or a chunk of
+    a file: task is (table, filepaths, chunk). Return the table and the
+    error, if any. With primary_keys, the files are upserted in the table
+    (see upsert_from_file)
+    """
+    table, filepaths, chunk = task
+    try:
+        with get_db_connection(dsn=dsn) as connection:
+            with connection.cursor() as c:
+                for filepath in filepaths:
+                    if primary_keys is not None:
+                        upsert_from_file(c, table + suffix, filepath, chunk,
+                                         primary_keys.get(table + suffix))
+                    else:
+                        copy_from_file(c, table + suffix, filepath, chunk)
+    except Exception, e:
+        return table, str(e).strip()
+    return table, None
 
 
 def update_from_csv(filepaths, connection, suffix=''):
@@ -30,12 +102,8 @@ def update_from_csv(filepaths, connection, suffix=''):
     for filepath in filepaths:
         table = basename(filepath).rsplit('.', 2)[0] + suffix
         try:
-            with open(filepath) as f, connection.cursor() as c:
-                columns = ','.join(['"%s"' % col for col in csv.reader(f).next()])
-                f.seek(0)
-                copy = ("COPY %s (%s) FROM STDOUT WITH CSV HEADER NULL ''"
-                        % (table, columns))
-                c.copy_expert(copy, f)
+            with connection.cursor() as c:
+                copy_from_file(c, table, filepath)
             LOG.info(u"SUCCESS updating %s" % table)
         except Exception, e:
             msg = e.message
@@ -46,17 +114,116 @@ def update_from_csv(filepaths, connection, suffix=''):
     return filepaths
 
 
-def import_from_csv(filepaths, connection, drop_fk=False, suffix=''):
+def import_from_csv(filepaths, connection, drop_fk=False, suffix='', levels=None,
+                    chunk_size=None, unchunked=(), upsert=False, primary_keys=None,
+                    imported=None, max_ids=None, callback=None):
     """ Import the csv file using postgresql COPY
+    Each table is imported and committed by a worker process. With the
+    levels of the tables (see depending.get_import_levels), the levels are
+    imported one after the other, so that the foreign key constraints are
+    satisfied without dropping them.
+    The csv files bigger than chunk_size bytes are split in chunks imported
+    and committed by several workers, except those of the unchunked tables and
+    of the tables without id. The indexes of these tables are dropped during
+    the import and then recreated. If a chunk fails, the rows committed by
+    the other chunks are deleted: they are those with an id above the
+    highest id of the table before its import, the rows they updated are
+    updated again by the next import.
+    With upsert, the rows already in the target tables are updated with
+    those of the files, given the primary_keys (see get_primary_keys).
+    The tables of the imported set are skipped, and the tables successfully
+    imported are added to it, also when the import of others fails, and
+    callback is called with them once their level is imported.
+    max_ids gives the highest ids of the tables before a previous attempt,
+    which may have committed rows of the tables not imported before it was
+    interrupted: the rows above are deleted before importing them again
     """
     assert all([exists(p) for p in filepaths])
+    if imported is None:
+        imported = set()
+    max_ids = dict(max_ids or {})
     with connection.cursor() as c:
         make_savepoint(c)
-    LOG.info(u'No Foreign Key constraints so straight import :)')
+    files = {}  # {table: filepaths}
+    for filepath in filepaths:
+        files.setdefault(basename(filepath).rsplit('.', 2)[0], []).append(filepath)
+    if drop_fk or levels is None:
+        LOG.info(u'No Foreign Key constraints so straight import :)')
+        levels = [sorted(files)]
+    else:
+        leveled = set(t for level in levels for t in level)
+        levels = levels + [sorted(t for t in files if t not in leveled)]
     p = Pool(20)  # arbitrary convert to variable
     try:
-        p.map(partial(__run_fast_import, dsn=connection.dsn, suffix=suffix),
-              sorted(filepaths, key=getsize, reverse=True))
+        for level in levels:
+            tasks = []  # (table, filepaths, chunk)
+            chunked = set()
+            tables = [t for t in level if t in files and t not in imported]
+            for table in tables:
+                whole = list(files[table])
+                for filepath in files[table]:
+                    if (chunk_size and table not in unchunked and filepath.endswith('.csv')
+                            and getsize(filepath) > chunk_size
+                            and 'id' in read_columns(filepath)):
+                        chunks = split_csv(filepath, chunk_size)
+                        whole.remove(filepath)
+                        chunked.add(table)
+                        tasks += [(table, [filepath], (start, end))
+                                  for start, end, _ in chunks]
+                if whole:
+                    tasks.append((table, whole, None))
+            if not tasks:
+                continue
+
+            def size(task):
+                table, paths, chunk = task
+                return chunk[1] - chunk[0] if chunk else sum(getsize(f) for f in paths)
+            tasks.sort(key=size, reverse=True)
+            if len(levels) > 1:
+                LOG.info(u'Importing %s', ', '.join(level))
+            with get_db_connection(dsn=connection.dsn) as index_connection:
+                with index_connection.cursor() as c:
+                    # the rows committed by an interrupted attempt are deleted
+                    current_ids = get_max_ids(c, [t for t in tables if t in max_ids], suffix)
+                    delete_imported_rows(c, {t: max_ids[t] for t, i in current_ids.iteritems()
+                                             if i > max_ids[t]}, suffix)
+                    max_ids.update(get_max_ids(c, [t for t in chunked if t not in max_ids], suffix))
+                    indexes = drop_indexes(c, [t + suffix for t in chunked])
+            try:
+                results = p.map(partial(__run_fast_import, dsn=connection.dsn, suffix=suffix,
+                                        primary_keys=(primary_keys or {}) if upsert else None),
+                                tasks, 1)
+            finally:
+                if indexes:
+                    LOG.info(u'Recreating %s indexes', len(indexes))
+                    with get_db_connection(dsn=connection.dsn) as index_connection:
+                        with index_connection.cursor() as c:
+                            for definition in indexes:
+                                c.execute(definition)
+            # one summary per table
+            errors = {}
+            for table, error in results:
+                errors.setdefault(table, [])
+                if error:
+                    errors[table].append(error)
+            for table in sorted(errors):
+                if errors[table]:
+                    LOG.error(u'FAILED importing %s: %s', table + suffix,
+                              '\n'.join(errors[table]))
+                else:
+                    LOG.info(u"SUCCESS importing %s" % (table + suffix))
+                    imported.add(table)
+                    if callback:
+                        callback(table)
+            failed = [t for t in sorted(errors) if errors[t]]
+            # the chunks of a failed table which were committed are deleted
+            partial_tables = {t: max_ids[t] for t in failed if t in chunked}
+            if partial_tables:
+                with get_db_connection(dsn=connection.dsn) as cleanup_connection:
+                    with cleanup_connection.cursor() as c:
+                        delete_imported_rows(c, partial_tables, suffix)
+            if failed:
+                raise ValueError(u'Could not import %s' % ', '.join(failed))
         return []
     except Exception, e:
         msg = e.message
@@ -64,5 +231,26 @@ def import_from_csv(filepaths, connection, drop_fk=False, suffix=''):
         cursor = connection.cursor()
         cursor.execute('ROLLBACK TO savepoint')
         cursor.close()
+    finally:
+        p.close()
+        p.join()
     return filepaths
 
+
+def get_max_ids(cursor, tables, suffix=''):
+    """ Return the highest id of each table before its import, 0 if empty
+    """
+    max_ids = {}
+    for table in tables:
+        cursor.execute('SELECT max(id) FROM %s' % (table + suffix))
+        max_ids[table] = cursor.fetchone()[0] or 0
+    return max_ids
+
+
+def delete_imported_rows(cursor, max_ids, suffix=''):
+    """ Delete the rows imported in the tables, whose ids are above the
+    highest id of the table before the import: {table: max_id}
+    """
+    for table, max_id in sorted(max_ids.items()):
+        LOG.info(u'Deleting the rows of %s imported by a failed attempt', table + suffix)
+        cursor.execute('DELETE FROM %s WHERE id > %%s' % (table + suffix), (max_id,))
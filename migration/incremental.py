@@ -0,0 +1,162 @@
+""" State of the incremental migrations, kept in the target database
+between runs: the first run migrates everything, the next ones only
+the rows created or written since the previous run, with the same ids
+"""
+import cPickle as pickle
+import psycopg2
+from os.path import basename, join
+
+from .idmap import IdMap, DiskIdMap
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+LOG = logging.getLogger(basename(__file__))
+
+STATE_TABLE = 'migration_state'
+
+
+def get_watermark(connection):
+    """ Return the start time of the oldest transaction running in the
+    database, in UTC like the write_date and create_date columns, which are
+    set to the start time of the writing transaction. Used with the
+    connection of the snapshot, the rows written by the transactions
+    committed after the snapshot are exported by the next run, even if these
+    transactions started before. The transactions of the other users are
+    only seen by a superuser or a member of pg_read_all_stats
+    """
+    with connection.cursor() as c:
+        c.execute("SELECT coalesce(min(xact_start), now()) AT TIME ZONE 'UTC' "
+                  "FROM pg_stat_activity "
+                  "WHERE datname = current_database() AND xact_start IS NOT NULL")
+        return c.fetchone()[0]
+
+
+def load_state(connection, name):
+    """ Return the state saved by the previous run of the migration
+    of a source database, or None
+    """
+    with connection.cursor() as c:
+        c.execute("SELECT 1 FROM pg_class WHERE relname = %s", (STATE_TABLE,))
+        if not c.fetchone():
+            return None
+        c.execute("SELECT watermark, state FROM %s WHERE name = %%s" % STATE_TABLE,
+                  (name,))
+        row = c.fetchone()
+    if row is None:
+        return None
+    state = pickle.loads(str(row[1]))
+    state['watermark'] = row[0]
+    LOG.info(u'Migrating the rows changed since %s', row[0])
+    return state
+
+
+def dump_state(processor, id_map_dir=None):
+    """ Return the mappings between source and target ids, the moved tables,
+    the references and the offsets and counters of the ids of a processor,
+    which can be pickled (see resume_state). With id_map_dir, the DiskIdMaps
+    are pickled as the paths of copies of their files in this directory,
+    otherwise they are loaded in memory. The IdMaps and the dicts, which
+    may be set by the mapping functions, are pickled as they are
+    """
+    mapping = processor.mapping
+    fk_mapping = {}
+    for table, ids in processor.fk_mapping.iteritems():
+        if not isinstance(ids, DiskIdMap):
+            fk_mapping[table] = ids
+        elif id_map_dir:
+            fk_mapping[table] = ids.freeze(join(id_map_dir, 'state_%s.ids' % table))
+        else:
+            # the files of the DiskIdMaps are removed at the end of the migration
+            fk_mapping[table] = IdMap(ids.iteritems())
+    return {
+        'fk_mapping': fk_mapping,
+        'is_moved': dict(processor.is_moved),
+        'ref_mapping': dict(processor.ref_mapping),
+        'max_target_id': dict(mapping.max_target_id),
+        'new_id': dict(mapping.new_id),
+        'id_ranges': dict(mapping.id_ranges),
+    }
+
+
+def get_id_ranges(mapping):
+    """ Return the offsets of the ids of the previous runs and of this one:
+    {target table: [(last source id, offset)]}, see Mapping.target_id
+    """
+    id_ranges = {t: list(ranges) for t, ranges in mapping.id_ranges.iteritems()}
+    for table, offset in mapping.max_target_id.iteritems():
+        ranges = id_ranges.setdefault(table, [])
+        last = mapping.max_source_id.get(table, 0)
+        if not ranges or last > ranges[-1][0]:
+            ranges.append((last, offset))
+    return id_ranges
+
+
+def save_state(connection, name, watermark, processor):
+    """ Save the watermark, the mappings between source and target ids
+    and the offsets of the ids of all the runs, for the next run
+    """
+    state = dump_state(processor)
+    state['id_ranges'] = get_id_ranges(processor.mapping)
+    data = psycopg2.Binary(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+    with connection.cursor() as c:
+        c.execute("CREATE TABLE IF NOT EXISTS %s ("
+                  "name varchar PRIMARY KEY, watermark timestamp, state bytea)"
+                  % STATE_TABLE)
+        c.execute("DELETE FROM %s WHERE name = %%s" % STATE_TABLE, (name,))
+        c.execute("INSERT INTO %s (name, watermark, state) VALUES (%%s, %%s, %%s)"
+                  % STATE_TABLE, (name, watermark, data))
+
+
+def restore_state(processor, state):
+    """ Continue from the state of the previous run: the rows migrated before
+    keep the offsets of their runs, and the foreign keys to them are fixed
+    with their mappings. The new source rows and the new ids of this run
+    are offset above the current max id of the target, which has the rows
+    of the previous runs and maybe records created since. The moved rows
+    keep the ids given by the previous runs.
+    Must be called after Mapping.set_database_ids
+    """
+    mapping = processor.mapping
+    for table, ranges in state['id_ranges'].iteritems():
+        mapping.id_ranges[table] = ranges
+        if table in mapping.max_target_id:
+            # max_target_id is the max id of the target, the new source ids
+            # and the new ids start after the last source id of the previous runs
+            last = ranges[-1][0]
+            mapping.max_target_id[table] -= last
+            mapping.new_id[table] = max(mapping.new_id.get(table, last), last)
+    for table, ids in state['fk_mapping'].iteritems():
+        if table not in processor.fk_mapping:
+            processor.fk_mapping[table] = processor.new_id_map()
+        processor.fk_mapping[table].update(ids.iteritems())
+        processor.restored_ids[table] = ids
+
+
+def resume_state(processor, state):
+    """ Restore the state returned by dump_state in the processor of the same
+    migration run again, as it was after the processing
+    """
+    mapping = processor.mapping
+    mapping.max_target_id.update(state['max_target_id'])
+    mapping.new_id.update(state['new_id'])
+    mapping.id_ranges.update(state['id_ranges'])
+    for table, ids in state['fk_mapping'].iteritems():
+        if table not in processor.fk_mapping:
+            processor.fk_mapping[table] = processor.new_id_map()
+        processor.fk_mapping[table].update(ids.iteritems())
+    processor.is_moved.update(state['is_moved'])
+    processor.ref_mapping.update(state['ref_mapping'])
+
+
+def get_delta_filters(column_types, watermark):
+    """ Return the where clauses selecting the rows created or written since
+    the watermark: {table: clause}, for the tables having these columns.
+    column_types is {table: {column: oid}}, see sql_commands.get_column_types
+    """
+    filters = {}
+    for table, columns in column_types.iteritems():
+        dates = [c for c in ('create_date', 'write_date') if c in columns]
+        if dates:
+            filters[table] = ' OR '.join(
+                "%s >= '%s'" % (column, watermark.isoformat()) for column in dates)
+    return filters
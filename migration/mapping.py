@@ -1,11 +1,36 @@
 # coding: utf-8
+import marshal
+import os
+import re
+import sys
 import psycopg2
 import yaml
 import logging
-from os.path import basename
+from bisect import bisect_left
+from collections import OrderedDict
+from hashlib import sha1
+from os.path import basename, exists, join
+from tempfile import mkstemp
+from .idmap import IdMap
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(basename(__file__))
 
+# the C yaml parser is much faster, if libyaml is available
+YamlLoader = getattr(yaml, 'CLoader', yaml.Loader)
+
+# the queries of sql() starting with these keywords are reads, unless a with
+# query contains an insert, update or delete
+READ_QUERY = re.compile(r'[\s(]*(select|with)\b', re.IGNORECASE)
+WRITE_KEYWORD = re.compile(r'\b(insert|update|delete)\b', re.IGNORECASE)
+
+
+def is_read_query(query):
+    """ Return True if an sql query only reads data
+    """
+    match = READ_QUERY.match(query)
+    return bool(match) and (match.group(1).lower() == 'select'
+                            or not WRITE_KEYWORD.search(query))
+
 
 class Mapping(object):
     """ Stores the mapping and offers a simple API
@@ -14,26 +39,83 @@ class Mapping(object):
     max_target_id = {}
     max_source_id = {}
     new_id = {}
+    # offsets of the ids migrated by the previous incremental runs:
+    # {target table: [(last source id, offset)]}, see incremental.py
+    id_ranges = {}
     target_connection = None
     source_connection = None
     fk2update = None
+    sql_cache_size = 10000  # number of results of sql() reads kept in memory
+    sql_batch_size = 1000  # number of sql() writes executed at once
 
-    def __init__(self, modules, filenames, drop_fk=False):
+    def __init__(self, modules, filenames, drop_fk=False, cache_dir=None):
         """ Open the file and compute the mappings
+        The mapping functions are compiled on demand, for the source tables
+        actually migrated (see compile_table). With a cache_dir, the parsed
+        mapping and the compiled code of all the functions are stored in a file
+        named after a hash of the mapping files, modules and options
         """
         self.target_tables = []
-        self.fk2update = {}
-        self.fkcache = {}
-        full_mapping = {}  # ends up as {'module': {'table': {'column': v}}}
+        self.fkcache = {}  # {(table, identifier): IdMap(source id: target id)}
+        self.fk_lookup_stats = {}  # {(table, identifier): [hits, misses]}
+        self.sql_cache = OrderedDict()  # {(db, sql, args): rows}, LRU
+        self.sql_writes = {'source': [], 'target': []}  # queued statements
         # load the full mapping file
         if isinstance(filenames, str):
             filenames = [filenames]
+        contents = []
         for filename in filenames:
             with open(filename) as stream:
-                full_mapping.update(yaml.load(stream))
+                contents.append(stream.read())
+        cache_path = None
+        if cache_dir:
+            key = sha1(marshal.dumps((sys.version, list(modules), drop_fk, contents)))
+            cache_path = join(cache_dir, 'mapping-%s.marshal' % key.hexdigest())
+        if cache_path and exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                cached = marshal.load(f)
+            LOG.info('Using the compiled mapping %s', cache_path)
+        else:
+            cached = self.parse(modules, contents, drop_fk)
+            if cache_path:
+                # compile everything once for the next runs
+                for functions in cached['functions'].values():
+                    for (incolumn, outcolumn), function in functions.items():
+                        functions[incolumn, outcolumn] = self.compile_function(
+                            incolumn, outcolumn, function)
+                try:
+                    data = marshal.dumps(cached)
+                except ValueError, e:  # e.g. yaml dates
+                    LOG.warn('The mapping can\'t be cached: %s', e)
+                else:
+                    if not exists(cache_dir):
+                        os.makedirs(cache_dir)
+                    fd, path = mkstemp(dir=cache_dir)
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(data)
+                    os.rename(path, cache_path)
+        self.mapping = cached['mapping']
+        self.deferred = cached['deferred']
+        self.fk2update = cached['fk2update']
+        self.discriminators = cached['discriminators']
+        self.stored_fields = cached['stored_fields']
+        self.lookups = cached.get('lookups', {})
+        # {source table: {(incolumn, outcolumn): function body or code}}
+        self.functions = cached['functions']
+
+    @staticmethod
+    def parse(modules, contents, drop_fk=False):
+        """ Parse and merge the yaml mapping files of the modules.
+        Function bodies are left as strings, also collected by source table
+        """
+        full_mapping = {}  # ends up as {'module': {'table': {'column': v}}}
+        for content in contents:
+            full_mapping.update(yaml.load(content, Loader=YamlLoader))
         # filter to keep only wanted modules
-        self.mapping = {}
-        self.deferred = {}
+        mapping = {}
+        deferred = {}
+        fk2update = {}
+        functions = {}
         for addon in modules:
             if addon not in full_mapping: # skip modules not in YAML files
                 LOG.warn('Mapping is not complete: module "%s" is missing!', addon)
@@ -47,22 +129,22 @@ class Mapping(object):
                     # skip special markers
                     continue
                 if (target_columns in ('__forget__', False) #if it needs forgetting
-                        or self.mapping.get(source_column) == '__forget__'):
-                    self.mapping[source_column] = '__forget__'
+                        or mapping.get(source_column) == '__forget__'):
+                    mapping[source_column] = '__forget__'
                     continue
                 if target_columns is None:
                     target_columns = {}
                 try:
-                    self.mapping.setdefault(source_column, target_columns)
-                    self.mapping[source_column].update(target_columns)
+                    mapping.setdefault(source_column, target_columns)
+                    mapping[source_column].update(target_columns)
                 except:
                     raise ValueError('Error in the mapping file: "%s" is invalid here'
                                      % repr(target_columns))
-        # replace function bodies with real functions
-        for incolumn in self.mapping:
-            targets = self.mapping[incolumn]
+        # collect the function bodies to compile
+        for incolumn in mapping:
+            targets = mapping[incolumn]
             if targets in (False, '__forget__'):
-                self.mapping[incolumn] = {}
+                mapping[incolumn] = {}
                 continue
             for outcolumn, function in targets.items():
                 # TODO Implement dispatcher here
@@ -72,51 +154,97 @@ class Mapping(object):
                     raise ValueError('Error in the mapping file: "%s" is invalid in %s'
                                      % (repr(function), outcolumn))
                 if function == '__defer__':
-                    self.mapping[incolumn][outcolumn] = '__copy__'
+                    mapping[incolumn][outcolumn] = '__copy__'
                     if not drop_fk:
                         table, column = outcolumn.split('.')
-                        self.deferred.setdefault(table, set())
-                        self.deferred[table].add(column)
+                        deferred.setdefault(table, set())
+                        deferred[table].add(column)
                     continue
                 if function.startswith('__fk__ '):
                     if len(function.split()) != 2:
                         raise ValueError('Error in the mapping file: "%s" is invalid in %s'
                                          % (repr(function), outcolumn))
-                    self.fk2update[outcolumn] = function.split()[1]
-                    self.mapping[incolumn][outcolumn] = '__copy__'
+                    fk2update[outcolumn] = function.split()[1]
+                    mapping[incolumn][outcolumn] = '__copy__'
                     continue
                 if function.startswith('__ref__'):
                     if len(function.split()) != 2:
                         raise ValueError('Error in the mapping file: "%s" is invalid in %s'
                                          % (repr(function), outcolumn))
                     # we handle that in the postprocess
-                    self.mapping[incolumn][outcolumn] = function
+                    mapping[incolumn][outcolumn] = function
                     continue
-                function_body = "def mapping_function(self, source_row, target_rows):\n"
-
                 #everything to here is special cases
-                function_body += '\n'.join([4*' ' + line for line in function.split('\n')])
-                mapping_function = None
-                exec(compile(function_body, '<' + incolumn + ' → ' + outcolumn + '>', 'exec'),
-                     globals().update({
-                         'newid': self.newid,
-                         'sql': self.sql,
-                         'fk_lookup': self.fk_lookup}))
-                self.mapping[incolumn][outcolumn] = mapping_function
-                del mapping_function
+                functions.setdefault(incolumn.split('.')[0], {})[incolumn, outcolumn] = function
 
         # build the discriminator mapping
         # build the stored field mapping.
-        self.discriminators = {}
-        self.stored_fields = {}
-        for mapping in full_mapping.values():
-            for key, value in mapping.items():
+        # build the fk lookups to preload.
+        discriminators = {}
+        stored_fields = {}
+        lookups = {}
+        for module_mapping in full_mapping.values():
+            for key, value in module_mapping.items():
                 if '__discriminator__' in key:
-                    self.discriminators.update({key.split('.')[0]: value})
+                    discriminators.update({key.split('.')[0]: value})
+                if '__lookup__' in key:
+                    table = key.split('.')[0]
+                    lookups.setdefault(table, [])
+                    lookups[table] += [value] if isinstance(value, str) else value
                 if '__stored__' in key:
                     table = key.split('.')[0]
-                    self.stored_fields.setdefault(table, [])
-                    self.stored_fields[table] += value
+                    stored_fields.setdefault(table, [])
+                    stored_fields[table] += value
+        return {'mapping': mapping, 'deferred': deferred, 'fk2update': fk2update,
+                'functions': functions, 'discriminators': discriminators,
+                'stored_fields': stored_fields, 'lookups': lookups}
+
+    @staticmethod
+    def compile_function(incolumn, outcolumn, function):
+        """ Compile the body of a mapping function. A body starting with
+        __batch__ is a batch function, called with a block of source rows
+        and their columns, and returning the list of the values of the block
+        """
+        if function.startswith('__batch__'):
+            function = function[len('__batch__'):].lstrip(' ').lstrip('\n')
+            function_body = "def batch_function(self, source_rows, columns):\n"
+        else:
+            function_body = "def mapping_function(self, source_row, target_rows):\n"
+        function_body += '\n'.join([4*' ' + line for line in function.split('\n')])
+        return compile(function_body, '<' + incolumn + ' → ' + outcolumn + '>', 'exec')
+
+    def compile_table(self, source_table):
+        """ Replace the function bodies of the mapping of a source table
+        with real functions
+        """
+        functions = self.functions.pop(source_table, None)
+        if not functions:
+            return
+        globals().update({
+            'newid': self.newid,
+            'sql': self.sql,
+            'fk_lookup': self.fk_lookup})
+        for (incolumn, outcolumn), function in functions.items():
+            if isinstance(function, str):
+                function = self.compile_function(incolumn, outcolumn, function)
+            namespace = {}
+            exec(function, globals(), namespace)
+            if 'batch_function' in namespace:
+                function = namespace['batch_function']
+                function.batch = True
+            else:
+                function = namespace['mapping_function']
+            self.mapping[incolumn][outcolumn] = function
+
+    def target_id(self, table, source_id):
+        """ Return the target id of a source id of a table: the source ids
+        migrated by a previous incremental run keep the offset of that run,
+        the others are offset by max_target_id
+        """
+        ranges = self.id_ranges.get(table)
+        if ranges and source_id <= ranges[-1][0]:
+            return source_id + ranges[bisect_left(ranges, (source_id,))][1]
+        return source_id + self.max_target_id[table]
 
     def newid(self, target_table):
         """ increment the global stored new_id for table
@@ -125,15 +253,63 @@ class Mapping(object):
         self.new_id[target_table] += 1
         return self.new_id[target_table]
 
-    def sql(self, db, sql, args=()):
+    def sql(self, db, sql, args=(), cache=True):
         """ execute an sql statement in the target db and return the value
         This method is available as a function in the mapping
+        The results of the select statements are cached, and the other
+        statements are queued and executed by batches, at the latest at the
+        end of the table (see flush_sql). A write invalidates the cached reads
+        of its database. With cache=False, the statement is executed at once
         """
         assert db in ('source', 'target'), u"First arg of sql() should be 'source' or 'target'"
+        read = is_read_query(sql)
+        if not cache:
+            self.flush_sql(db)
+            if not read:
+                self.clear_sql_cache(db)
+            return self.execute_sql(db, sql, args, read)
+        if not read:
+            self.clear_sql_cache(db)
+            self.sql_writes[db].append((sql, args))
+            if len(self.sql_writes[db]) >= self.sql_batch_size:
+                self.flush_sql(db)
+            return ()
+        key = (db, sql, tuple(sorted(args.items())) if isinstance(args, dict) else tuple(args))
+        try:
+            rows = self.sql_cache.pop(key)
+        except KeyError:
+            self.flush_sql(db)
+            rows = self.execute_sql(db, sql, args, read)
+            while len(self.sql_cache) >= self.sql_cache_size > 0:
+                self.sql_cache.popitem(last=False)
+        except TypeError:  # unhashable args
+            self.flush_sql(db)
+            return self.execute_sql(db, sql, args, read)
+        if self.sql_cache_size > 0:
+            self.sql_cache[key] = rows
+        return list(rows)
+
+    def execute_sql(self, db, sql, args, read):
         connection = self.target_connection if db == 'target' else self.source_connection
         with connection.cursor() as cursor:
             cursor.execute(sql, args)
-            return cursor.fetchall() if 'select ' in sql.lower() else ()
+            return cursor.fetchall() if read else ()
+
+    def clear_sql_cache(self, db):
+        for key in [k for k in self.sql_cache if k[0] == db]:
+            del self.sql_cache[key]
+
+    def flush_sql(self, db=None):
+        """ Execute the queued sql() writes of a database, or of both,
+        in a single multi-statement query
+        """
+        for db in [db] if db else sorted(self.sql_writes):
+            writes, self.sql_writes[db] = self.sql_writes[db], []
+            if not writes:
+                continue
+            connection = self.target_connection if db == 'target' else self.source_connection
+            with connection.cursor() as cursor:
+                cursor.execute(';\n'.join(cursor.mogrify(sql, args) for sql, args in writes))
 
     def fk_lookup(self, table, identifier, arg, exc=False):
         """
@@ -141,41 +317,78 @@ class Mapping(object):
         in associated models.  This helper function looks up a unique identifier
         in the source table and searches for it in the destination returning the
         id.  Example usage are tables such as ir_model.
-        NOTE: The results are cached for performance, and the key is not unique
-        to the source_row table.  So if model_id in mail_alias and model_id in
-        another model, they use the same cache.
+        NOTE: The index of a table and identifier is loaded at the first call,
+        or before the processing if declared with __lookup__ in the mapping,
+        and shared by all the mapping functions using it.
         :param table: the database table to search e.g. ir_model
         :param identifier: the database column to search in the target e.g. model
         :param arg: the row value to search for in the source e.g. source_row['model_id']
-        :param exc: wether to raise an indexerror or set NULL if a match not found
+        :param exc: wether to raise a KeyError or set NULL if a match not found
         :return:
         """
+        key = (table, identifier)
+        index = self.fkcache.get(key)
+        if index is None:
+            index = self.load_fk_lookup(table, identifier)
+        try:
+            target_id = index.get(int(arg))
+        except (TypeError, ValueError):  # NULL
+            target_id = None
+        stats = self.fk_lookup_stats.setdefault(key, [0, 0])
+        if target_id is None:
+            stats[1] += 1
+            if exc:
+                raise KeyError(arg)
+            return False
+        stats[0] += 1
+        return target_id
 
-        key = '%s_%s' % (table, identifier)
-        if key not in self.fkcache:
-            self.fkcache[key] = {}
-
-            with self.source_connection.cursor() as cr:
-                cr.execute('SELECT %s, id '
-                           'FROM %s;' % (identifier, table))
-                source_res = {r[0]: str(r[1]) for r in cr.fetchall()}
-            with self.target_connection.cursor() as cr:
-                cr.execute('SELECT %s, id '
-                           'FROM %s ' % (identifier, table))
-                target_res = {str(r[1]): r[0] for r in cr.fetchall()}
-            for fk, val in target_res.items():
-                if val in source_res:
-                    self.fkcache[source_res[val]] = fk
-        if exc:
-            return self.fkcache[key][arg]
-        else:
-            return self.fkcache[key].get(arg, False)
+    def load_fk_lookup(self, table, identifier):
+        """ Load the index of source ids to target ids of a fk_lookup,
+        with one streamed query in each database
+        """
+        query = 'SELECT %s, id FROM %s WHERE %s IS NOT NULL' % (identifier, table, identifier)
+        target_ids = dict(iter_query(self.target_connection, query))
+        index = IdMap()
+        for value, source_id in iter_query(self.source_connection, query):
+            target_id = target_ids.get(value)
+            if target_id is not None:
+                index[source_id] = target_id
+        index.compact()
+        LOG.info(u'Loaded the fk lookup of %s.%s: %s ids found in the target',
+                 table, identifier, len(index))
+        self.fkcache[table, identifier] = index
+        return index
+
+    def preload_fk_lookups(self):
+        """ Load the fk lookups declared in the mapping with __lookup__, so
+        that the worker processes don't load them each on their own
+        """
+        for table, identifiers in sorted(self.lookups.items()):
+            for identifier in identifiers:
+                if (table, identifier) not in self.fkcache:
+                    self.load_fk_lookup(table, identifier)
+
+    def merge_fk_lookup_stats(self, stats):
+        """ Add the counters of fk lookups of a worker process
+        """
+        for key, (hits, misses) in stats.iteritems():
+            counters = self.fk_lookup_stats.setdefault(key, [0, 0])
+            counters[0] += hits
+            counters[1] += misses
+
+    def log_fk_lookup_stats(self):
+        for (table, identifier), (hits, misses) in sorted(self.fk_lookup_stats.items()):
+            LOG.info(u'fk lookup of %s.%s: %s hits, %s misses',
+                     table, identifier, hits, misses)
 
     def get_target_column(self, source, column):
         """ Return the target mapping for a column or table
         """
         # Refactor as never called without column
         tbl_col = source + '.' + column
+        if source in self.functions:
+            self.compile_table(source)
         mapping = self.mapping.get(tbl_col, None)
         # not found? We look for wildcards
         if mapping is None:
@@ -267,3 +480,12 @@ class Mapping(object):
                         t.execute("ALTER SEQUENCE %s_id_seq RESTART WITH %d;" % (table, newid+1))
 
 
+def iter_query(connection, query, itersize=10000):
+    """ Iterate the rows of a query with a server-side cursor,
+    fetching itersize rows at a time
+    """
+    with connection.cursor('iter_query') as cursor:
+        cursor.itersize = itersize
+        cursor.execute(query)
+        for row in cursor:
+            yield row
@@ -2,21 +2,30 @@ import sys
 import time
 
 import shutil
+import cPickle as pickle
 import argparse
+from functools import partial
 from ConfigParser import SafeConfigParser
 
 from tempfile import mkdtemp
 from .exporting import export_to_csv, extract_existing
-from .importing import import_from_csv
+from .importing import import_from_csv, get_max_ids
+from .streaming import stream_tables
 from .mapping import Mapping
 from .processing import CSVProcessor
-from .depending import add_related_tables
-from .depending import get_fk_to_update
+from .idmap import set_cache_size
+from .depending import add_related_tables, DependencyGraph
+from .depending import get_foreign_keys, get_import_levels, get_self_references
 from .sql_commands import drop_constraints, get_management_connection, get_db_connection, create_new_db, kill_db_connections
+from .sql_commands import get_column_types, get_primary_keys, export_snapshot
+from .caching import SchemaCache
+from .incremental import get_watermark, load_state, save_state, restore_state
+from .incremental import get_delta_filters, dump_state, resume_state
+from .checkpoint import Manifest
 
 import logging
 from os.path import basename, join, abspath, dirname, exists, normpath
-from os import listdir
+from os import listdir, makedirs, remove
 
 HERE = dirname(__file__)
 logging.basicConfig(level=logging.DEBUG)
@@ -95,6 +104,66 @@ def main():
                         action='store_true', default=False,
                         help=u'Will automatically drop columns '
                              u'not in the target database')
+    parser.add_argument('-j', '--processes',
+                        type=int, default=1,
+                        help=u'Number of processes used to process '
+                             u'independent tables in parallel')
+    parser.add_argument('--chunksize',
+                        type=int, default=256,
+                        help=u'Size in MB above which a csv file is split '
+                             u'in chunks processed in parallel '
+                             u'(with --processes), and imported in parallel')
+    parser.add_argument('--singlepass',
+                        action='store_true', default=False,
+                        help=u'Fix foreign keys while processing, without '
+                             u'writing intermediate csv files. '
+                             u'Not compatible with --processes')
+    parser.add_argument('--stream',
+                        action='store_true', default=False,
+                        help=u'Stream tables which don\'t need to be merged '
+                             u'from the source to the target database, '
+                             u'without csv files')
+    parser.add_argument('--binary',
+                        action='store_true', default=False,
+                        help=u'Use the binary format of COPY for the tables '
+                             u'which only need their ids and foreign keys '
+                             u'to be fixed')
+    parser.add_argument('--diskidmaps',
+                        action='store_true', default=False,
+                        help=u'Store the mappings between source and target '
+                             u'ids on disk, for migrations which don\'t fit '
+                             u'in memory')
+    parser.add_argument('--idcache',
+                        type=int, default=256,
+                        help=u'Size in MB of the memory cache of the ids '
+                             u'stored on disk (with --diskidmaps)')
+    parser.add_argument('--schemacache',
+                        nargs='?', const='schema_cache', default=None,
+                        metavar='DIRECTORY',
+                        help=u'Store the metadata read from the schemas of '
+                             u'the databases in this directory (schema_cache '
+                             u'by default), and reuse it until they change')
+    parser.add_argument('--mappingcache',
+                        nargs='?', const='mapping_cache', default=None,
+                        metavar='DIRECTORY',
+                        help=u'Store the parsed and compiled mapping in this '
+                             u'directory (mapping_cache by default), and reuse '
+                             u'it until the mapping files change')
+    parser.add_argument('--partsize',
+                        type=int, default=1024,
+                        help=u'Size in MB above which a table is exported '
+                             u'in ranges of ids by several connections')
+    parser.add_argument('--incremental',
+                        action='store_true', default=False,
+                        help=u'Save the state of the migration in the target '
+                             u'database, and only migrate the rows created or '
+                             u'written since the previous incremental migration '
+                             u'of the same source database')
+    parser.add_argument('--resume',
+                        metavar='IDENTIFIER',
+                        help=u'Resume the failed migration with this identifier '
+                             u'from its first incomplete stage, with the same '
+                             u'options. Its directory must have been kept')
 
 
     args = parser.parse_args()
@@ -132,8 +201,14 @@ def main():
         sys.exit(1)
 
     temppath = abspath(args.tmpfs and '/dev/shm' or '.')
-    tempdir = mkdtemp(prefix=source_db + '_' + identifier + '_',
-                      dir=temppath)
+    if args.resume:
+        tempdir = join(temppath, args.resume)
+        if not exists(tempdir):
+            print(u'No directory %s to resume the migration from' % tempdir)
+            sys.exit(1)
+    else:
+        tempdir = mkdtemp(prefix=source_db + '_' + identifier + '_',
+                          dir=temppath)
 
     identifier = basename(normpath(tempdir))
     if args.quick and not args.newdb:
@@ -144,7 +219,13 @@ def main():
     migrate(source_db, target_db, relation, mapping_names,
             excluded, target_dir=tempdir, write=args.write,
             new_db=args.newdb, drop_fk=args.dropfk, del_csv=args.tmpfs,
-            forget_missing=args.forgetmissing, owner=args.owner)
+            forget_missing=args.forgetmissing, owner=args.owner,
+            processes=args.processes, chunk_size=args.chunksize,
+            single_pass=args.singlepass, stream=args.stream,
+            binary=args.binary, disk_id_maps=args.diskidmaps,
+            id_cache_size=args.idcache, schema_cache=args.schemacache,
+            mapping_cache=args.mappingcache, part_size=args.partsize,
+            incremental=args.incremental)
     print(u'The identifier for this migration is "{0}"'.format(identifier))
 
     if not args.keepcsv:
@@ -154,42 +235,115 @@ def main():
 def migrate(source_db, target_db, source_tables, mapping_names,
             excluded=None, target_dir=None, write=False,
             new_db=False, drop_fk=False, del_csv=False,
-            forget_missing=False, owner=False):
+            forget_missing=False, owner=False, processes=1, chunk_size=None,
+            single_pass=False, stream=False, binary=False,
+            disk_id_maps=False, id_cache_size=256, schema_cache=None,
+            mapping_cache=None, part_size=None, incremental=False):
     """ The main migration function
+    The completed stages are recorded in a manifest in the target_dir, and
+    skipped when the migration is run again in the same directory
     """
     start_time = time.time()
+    manifest = Manifest(target_dir)
+    if manifest.check():
+        LOG.info(u'Resuming the migration after the %s stages', ', '.join(manifest.stages))
     source_connection = get_db_connection(dsn="dbname=%s" % source_db)
-    if new_db:
+    part_size = part_size and part_size * 1024 * 1024
+    # the source tables are all exported from this snapshot, kept until the end
+    # of the exports, so that they are consistent even if the source is used
+    snapshot_connection = get_db_connection(dsn=source_connection.dsn)
+    snapshot = export_snapshot(snapshot_connection)
+    if new_db and manifest.is_done('new_db'):
+        target_db = new_db
+    elif new_db:
         target_db = create_new_db(source_db, target_db, new_db, owner)
+        manifest.complete('new_db')
     target_connection = get_db_connection(dsn="dbname=%s" % target_db)
+    # with the state of a previous incremental migration, only migrate the delta
+    state = watermark = None
+    if incremental:
+        # the watermark of the first attempt
+        watermark = manifest.get('watermark') or get_watermark(snapshot_connection)
+        manifest.set('watermark', watermark)
+        state = load_state(target_connection, source_db)
+        if state is not None and stream:
+            LOG.warn(u'Not streaming the tables of an incremental migration')
+            stream = False
+    # the streamed tables are read from the snapshot of this attempt, so the
+    # other tables are exported again from the same snapshot, unless the rows
+    # of the previous snapshot were already committed
+    if (stream and manifest.is_done('export') and not manifest.is_done('import')
+            and (manifest.get('streamed_tables') or not manifest.is_done('process'))):
+        if manifest.get('imported') or manifest.get('streamed'):
+            print(u'The tables already imported were exported from another snapshot '
+                  u'than the streamed tables: please migrate again without --resume')
+            sys.exit(1)
+        LOG.warn(u'Exporting the tables again from the snapshot of the streamed tables')
+        manifest.reset('export')
 
     # Get the list of modules installed in the target db
     with target_connection.cursor() as c:
         c.execute("select name from ir_module_module where state='installed'")
         target_modules = [m[0] for m in c.fetchall()]
 
+    # metadata of the schemas reused between runs
+    source_cache = target_cache = None
+    if schema_cache:
+        source_cache = SchemaCache(schema_cache, source_connection)
+        target_cache = SchemaCache(schema_cache, target_connection)
+
+    def cached(cache, key, compute):
+        return cache.get(key, compute) if cache else compute()
+
     # we turn the list of wanted tables into the full list of required tables
     print(u'Computing the real list of tables to export...')
     if drop_fk:
         print(u'Normally you would get a list of dependencies here but we don\'t care'
               u' as we are dropping the constraints')
+    graph = cached(source_cache, 'dependency_graph',
+                   partial(DependencyGraph, source_connection))
     source_tables, m2m_tables = add_related_tables(source_connection, source_tables,
-                                                   excluded, show_log=not drop_fk)
+                                                   excluded, show_log=not drop_fk,
+                                                   graph=graph)
 
     LOG.info(u'The real list of tables to export is:\n%s' % '\n'.join(
         make_a_nice_list(source_tables)))
     with open('export.txt', 'w') as f:
         f.write('\n'.join(make_a_nice_list(source_tables)))
 
+    filters = None
+    if state is not None:
+        filters = get_delta_filters(
+            get_column_types(source_connection, source_tables), state['watermark'])
+
     # construct the mapping and the csv processor
     print('Exporting tables as CSV files...')
-    filepaths = export_to_csv(source_tables, target_dir, source_connection)
+    # when streaming or with binary COPY, only export the headers
+    # until we know which tables are streamed or exported in binary
+    if manifest.is_done('export'):
+        filepaths = [join(target_dir, t + '.csv') for t in source_tables]
+    else:
+        filepaths = export_to_csv(source_tables, target_dir, source_connection,
+                                  header_only=stream or binary, snapshot=snapshot,
+                                  part_size=part_size, filters=filters)
     for i, mapping_name in enumerate(mapping_names):
         if not exists(mapping_name):
             mapping_names[i] = join(HERE, 'mappings', mapping_name)
             LOG.warn('%s not found. Trying %s', mapping_name, mapping_names[i])
-    mapping = Mapping(target_modules, mapping_names, drop_fk=drop_fk)
-    processor = CSVProcessor(mapping)
+    mapping = Mapping(target_modules, mapping_names, drop_fk=drop_fk,
+                      cache_dir=mapping_cache)
+    # the files of the id maps, also those created by the worker processes,
+    # are removed with their directory at the end of the migration
+    id_map_dir = None
+    if disk_id_maps:
+        set_cache_size(id_cache_size * 1024 * 1024)
+        id_map_dir = join(target_dir, 'id_maps')
+        if not exists(id_map_dir):
+            makedirs(id_map_dir)
+    processor = CSVProcessor(mapping,
+                             chunk_size=chunk_size and chunk_size * 1024 * 1024,
+                             id_map_dir=id_map_dir,
+                             schema_cache=target_cache)
 
     target_tables = processor.get_target_columns(
         filepaths, forget_missing, target_connection).keys()
@@ -200,11 +354,40 @@ def migrate(source_db, target_db, source_tables, mapping_names,
         f.write('\n'.join(make_a_nice_list(target_tables)))
     processor.mapping.set_database_ids(source_tables, source_connection,
                                        target_tables, target_connection)
+    if state is not None:
+        # the rows of the previous runs keep their ids, the new ones are offset
+        # above the current ids of the target
+        restore_state(processor, state)
 
 
     print('Computing the list of Foreign Keys '
           'to update in the target csv files...')
-    processor.fk2update = get_fk_to_update(target_connection, target_tables)
+    foreign_keys = cached(target_cache, ('foreign_keys', tuple(sorted(target_tables))),
+                          partial(get_foreign_keys, target_connection, target_tables))
+    processor.fk2update = {fk: pointed_table for fk, (pointed_table, _)
+                           in foreign_keys.iteritems()}
+    # read before the constraints may be dropped
+    primary_keys = cached(target_cache, ('primary_keys', tuple(sorted(target_tables))),
+                          partial(get_primary_keys, target_connection, target_tables))
+
+    # order the import by levels of foreign keys, and defer the foreign keys
+    # of the cycles so that the import doesn't need to drop the constraints.
+    # The NOT NULL foreign keys can't be deferred, unless they are dropped
+    try:
+        import_levels, cyclic_fks = get_import_levels(
+            target_tables, processor.fk2update, mapping.deferred,
+            not_null=() if drop_fk else set(
+                fk for fk, (_, not_null) in foreign_keys.iteritems() if not_null))
+    except ValueError as e:
+        print(e)
+        print(u'Please break the cycle in the mapping, or use --dropfk')
+        sys.exit(1)
+    if not drop_fk:
+        for table, columns in cyclic_fks.iteritems():
+            mapping.deferred.setdefault(table, set()).update(columns)
+    # the rows of these tables can't be imported in parallel chunks
+    self_referencing = set() if drop_fk else get_self_references(
+        processor.fk2update, mapping.deferred)
 
     # update the list of fk to update with the fake __fk__ given in the mapping
     processor.fk2update.update(processor.mapping.fk2update)
@@ -216,10 +399,78 @@ def migrate(source_db, target_db, source_tables, mapping_names,
     # create migrated csv files from exported csv files
     print(u'Migrating CSV files...')
     processor.set_existing_data(existing_records)
-    processor.process(target_dir, filepaths, target_dir,
-                      target_connection, del_csv=del_csv)
+    # load the fk lookups declared in the mapping before forking the workers
+    processor.mapping.preload_fk_lookups()
+    streamed_tables, binary_tables = [], {}
+    if manifest.is_done('process'):
+        # the source files may have been removed by the processing
+        streamed_tables = manifest.get('streamed_tables')
+        binary_tables = manifest.get('binary_tables')
+    elif stream or binary:
+        streamable_tables = processor.get_streamable_tables(target_dir, source_tables)
+        if binary:
+            binary_tables = processor.get_binary_tables(
+                target_dir, streamable_tables,
+                cached(source_cache, ('column_types', tuple(sorted(streamable_tables))),
+                       partial(get_column_types, source_connection, streamable_tables)),
+                cached(target_cache, ('column_types', tuple(sorted(target_tables))),
+                       partial(get_column_types, target_connection, target_tables)))
+            LOG.info(u'The tables to migrate with binary COPY are:\n%s' % '\n'.join(
+                make_a_nice_list(binary_tables.keys())))
+        if stream:
+            streamed_tables = streamable_tables
+            LOG.info(u'The tables to stream are:\n%s' % '\n'.join(
+                make_a_nice_list(streamed_tables)))
+        elif not manifest.is_done('export'):
+            export_to_csv(binary_tables.keys(), target_dir, source_connection, binary=True,
+                          snapshot=snapshot, part_size=part_size, filters=filters)
+        if not manifest.is_done('export'):
+            export_to_csv([t for t in source_tables
+                           if t not in streamed_tables and t not in binary_tables],
+                          target_dir, source_connection, snapshot=snapshot,
+                          part_size=part_size, filters=filters)
+    if not manifest.is_done('export'):
+        manifest.complete('export', filepaths + [join(target_dir, t + '.bin')
+                                                 for t in binary_tables])
+
+    # the target files, with the update files they may need
+    target_files = [join(target_dir, '%s.target2.csv' % t) for
+                    t in target_tables]
+    if not stream:
+        target_files += [join(target_dir, '%s.target2.bin' % t)
+                         for t in set(binary_tables.values())]
+    update_files = [join(target_dir, t + '.update2.csv') for t in target_tables]
+    # the state of the processor, with the paths of the DiskIdMaps
+    state_file = join(target_dir, 'processor.pickle')
+    if manifest.is_done('process'):
+        with open(state_file, 'rb') as f:
+            resume_state(processor, pickle.load(f))
+        processor.lines = manifest.get('lines')
+    else:
+        # the deferred updates of a previous attempt are split again
+        for table in target_tables:
+            if exists(join(target_dir, table + '.deferred2.csv')):
+                remove(join(target_dir, table + '.deferred2.csv'))
+        processor.process(target_dir,
+                          [p for p in filepaths
+                           if basename(p).rsplit('.', 1)[0] not in streamed_tables
+                           and basename(p).rsplit('.', 1)[0] not in binary_tables],
+                          target_dir, target_connection, del_csv=del_csv,
+                          processes=processes, single_pass=single_pass)
+        if binary_tables and not stream:
+            # the fk mapping is complete once the other tables are processed
+            processor.process_binary(target_dir, binary_tables, target_dir)
+        processor.mapping.log_fk_lookup_stats()
+        with open(state_file, 'wb') as f:
+            pickle.dump(dump_state(processor, id_map_dir), f, pickle.HIGHEST_PROTOCOL)
+        manifest.data.update(streamed_tables=streamed_tables, binary_tables=binary_tables,
+                             lines=processor.lines)
+        manifest.complete('process', target_files + update_files + [state_file])
     # drop foreign key constraints
-    if drop_fk:
+    if drop_fk and manifest.get('add_constraints_sql'):
+        # already dropped by a previous attempt
+        add_constraints_sql = manifest.get('add_constraints_sql')
+    elif drop_fk:
         print(u'Dropping Foreign Key Constraints in target tables')
         target_connection.close()
         mgmt_connection = get_management_connection(source_db)
@@ -233,21 +484,48 @@ def migrate(source_db, target_db, source_tables, mapping_names,
         else:
             with open('add_constraints.sql', 'w') as f:
                 f.write(add_constraints_sql)
+            manifest.set('add_constraints_sql', add_constraints_sql)
 
         target_connection = get_db_connection(dsn="dbname=%s" % target_db)
 
     # import data in the target
-    print(u'Trying to import data in the target database...')
-    target_files = [join(target_dir, '%s.target2.csv' % t) for
-                    t in target_tables]
-    remaining = import_from_csv(
-        target_files, target_connection, drop_fk=drop_fk)
-    if remaining:
-        print(u'Please improve the mapping by inspecting the errors above')
-        sys.exit(1)
+    if not manifest.is_done('import'):
+        print(u'Trying to import data in the target database...')
+        # the tables imported by a previous attempt are skipped
+        imported = set(manifest.get('imported', ()))
+        # the highest ids before the first attempt: the rows above them in the
+        # tables not imported were committed by an interrupted attempt
+        max_ids = manifest.get('max_ids')
+        if max_ids is None:
+            with target_connection.cursor() as c:
+                max_ids = get_max_ids(c, [t for t in target_tables if primary_keys.get(t) == 'id'])
+            manifest.set('max_ids', max_ids)
+        # the rows of a delta may have been migrated by the previous runs. Only the
+        # tables with an id are updated, the rows of the relation tables are kept
+        remaining = import_from_csv(
+            target_files, target_connection, drop_fk=drop_fk, levels=import_levels,
+            chunk_size=chunk_size and chunk_size * 1024 * 1024, unchunked=self_referencing,
+            upsert=state is not None,
+            primary_keys={t: k for t, k in primary_keys.iteritems() if k == 'id'},
+            imported=imported, max_ids=max_ids,
+            callback=lambda table: manifest.set(
+                'imported', manifest.get('imported', []) + [table]))
+        if remaining:
+            print(u'Please improve the mapping by inspecting the errors above')
+            sys.exit(1)
+        if streamed_tables:
+            print(u'Streaming data from the source to the target database...')
+            # the streamed tables are recorded as soon as they are committed
+            stream_tables(processor, target_dir, streamed_tables,
+                          source_connection.dsn, target_connection.dsn,
+                          binary_tables=binary_tables, snapshot=snapshot,
+                          streamed=manifest.get('streamed', ()),
+                          callback=lambda table: manifest.set(
+                              'streamed', manifest.get('streamed', []) + [table]))
+        manifest.complete('import')
+    snapshot_connection.close()
 
     # execute deferred updates for preexisting data
-    print(u'Updating pre-existing data...')
     filepaths = []
     for table in target_tables:
         filepath = join(target_dir, table + '.update2.csv')
@@ -255,18 +533,34 @@ def migrate(source_db, target_db, source_tables, mapping_names,
             filepaths.append(filepath)
         else:
             LOG.warn(u'Not updating %s as it was not imported', table)
-    processor.update_all(filepaths, target_connection, suffix="_temp")
-
-    # Drop stored fields (e.g. related and computed)
-    processor.drop_stored_columns(target_connection)
-
-    if write:
-        target_connection.commit()
-        print(u'Finished, and transaction committed !! \o/')
-    else:
-        target_connection.rollback()
-        print(u'Finished \o/ Use --write to really '
-              u'write to the target database')
+    if not manifest.is_done('deferred'):
+        # the deferred columns are updated through narrow temp tables, committed
+        # in parallel with --write, otherwise in the transaction rolled back
+        processor.update_deferred(filepaths, target_connection, suffix="_deferred",
+                                  primary_keys=primary_keys, processes=processes,
+                                  commit=write)
+        if write:
+            manifest.complete('deferred', filepaths)
+    # the other updates are committed at the end, with --write
+    if not manifest.is_done('update'):
+        print(u'Updating pre-existing data...')
+        processor.update_all(filepaths, target_connection, suffix="_temp",
+                             primary_keys=primary_keys)
+
+        # Drop stored fields (e.g. related and computed)
+        processor.drop_stored_columns(target_connection)
+
+        if incremental:
+            save_state(target_connection, source_db, watermark, processor)
+
+        if write:
+            target_connection.commit()
+            manifest.complete('update')
+            print(u'Finished, and transaction committed !! \o/')
+        else:
+            target_connection.rollback()
+            print(u'Finished \o/ Use --write to really '
+                  u'write to the target database')
     target_connection.close()
 
     # Note we check here again just in case
@@ -292,6 +586,9 @@ def migrate(source_db, target_db, source_tables, mapping_names,
         target_connection = get_db_connection(dsn="dbname=%s" % target_db)
         mapping.update_database_sequences(target_connection)
 
+    if id_map_dir:
+        shutil.rmtree(id_map_dir)
+
     seconds = time.time() - start_time
     lines = processor.lines
     rate = lines / seconds
@@ -0,0 +1,138 @@
+""" Encoder and decoder for the binary format of the postgresql COPY command
+See http://www.postgresql.org/docs/current/static/sql-copy.html
+
+Rows are lists of raw field values (the bytes sent by postgresql, or None
+for NULL), so that columns can be passed through without being decoded.
+decode() and encode() convert the values of the common types.
+"""
+import struct
+from datetime import datetime, timedelta
+
+SIGNATURE = 'PGCOPY\n\xff\r\n\x00'
+HEADER = SIGNATURE + struct.pack('>ii', 0, 0)  # no flags, no header extension
+TRAILER = struct.pack('>h', -1)
+
+# type oids
+BOOL, BYTEA, NAME, INT8, INT2, INT4, TEXT = 16, 17, 19, 20, 21, 23, 25
+FLOAT4, FLOAT8, BPCHAR, VARCHAR, DATE, TIMESTAMP = 700, 701, 1042, 1043, 1082, 1114
+INTEGERS = (INT2, INT4, INT8)
+MAX_INTS = {INT2: 2 ** 15 - 1, INT4: 2 ** 31 - 1, INT8: 2 ** 63 - 1}
+
+EPOCH = datetime(2000, 1, 1)
+INT_FORMATS = {2: '>h', 4: '>i', 8: '>q'}
+
+_int16 = struct.Struct('>h')
+_int32 = struct.Struct('>i')
+
+
+def read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError(u'Unexpected end of binary COPY data')
+    return data
+
+
+def read_rows(f):
+    """ Read the binary COPY data from a file and yield the rows
+    """
+    if read_exactly(f, len(SIGNATURE)) != SIGNATURE:
+        raise ValueError(u'Invalid binary COPY signature')
+    flags, extension = struct.unpack('>ii', read_exactly(f, 8))
+    if flags & 0xffff0000:
+        raise ValueError(u'Unsupported binary COPY flags %s' % flags)
+    read_exactly(f, extension)
+    while True:
+        count = _int16.unpack(read_exactly(f, 2))[0]
+        if count == -1:
+            return
+        row = []
+        for _ in xrange(count):
+            size = _int32.unpack(read_exactly(f, 4))[0]
+            row.append(None if size == -1 else read_exactly(f, size))
+        yield row
+
+
+class BinaryWriter(object):
+    """ Write rows in the binary COPY format. close() writes the trailer
+    """
+    def __init__(self, f):
+        self.f = f
+        f.write(HEADER)
+
+    def writerow(self, row):
+        parts = [_int16.pack(len(row))]
+        for value in row:
+            if value is None:
+                parts.append(_int32.pack(-1))
+            else:
+                parts.append(_int32.pack(len(value)))
+                parts.append(value)
+        self.f.write(''.join(parts))
+
+    def close(self):
+        self.f.write(TRAILER)
+
+
+def decode_int(value):
+    """ Decode an int2, int4 or int8 value
+    """
+    return struct.unpack(INT_FORMATS[len(value)], value)[0]
+
+
+def encode_int(number, size):
+    """ Encode an integer on 2, 4 or 8 bytes
+    """
+    try:
+        return struct.pack(INT_FORMATS[size], number)
+    except struct.error:
+        raise ValueError(u'%s does not fit in an integer of %s bytes' % (number, size))
+
+
+def decode(oid, value):
+    """ Decode a binary value of the given type
+    """
+    if value is None:
+        return None
+    if oid in INTEGERS:
+        return decode_int(value)
+    if oid in (TEXT, VARCHAR, BPCHAR, NAME):
+        return value.decode('utf-8')
+    if oid == BOOL:
+        return value == '\x01'
+    if oid == FLOAT4:
+        return struct.unpack('>f', value)[0]
+    if oid == FLOAT8:
+        return struct.unpack('>d', value)[0]
+    if oid == DATE:
+        return EPOCH.date() + timedelta(days=_int32.unpack(value)[0])
+    if oid == TIMESTAMP:
+        return EPOCH + timedelta(microseconds=struct.unpack('>q', value)[0])
+    if oid == BYTEA:
+        return value
+    raise ValueError(u'Unsupported type oid %s' % oid)
+
+
+def encode(oid, value):
+    """ Encode a value in the binary format of the given type
+    """
+    if value is None:
+        return None
+    if oid in INTEGERS:
+        return encode_int(value, {INT2: 2, INT4: 4, INT8: 8}[oid])
+    if oid in (TEXT, VARCHAR, BPCHAR, NAME):
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+    if oid == BOOL:
+        return value and '\x01' or '\x00'
+    if oid == FLOAT4:
+        return struct.pack('>f', value)
+    if oid == FLOAT8:
+        return struct.pack('>d', value)
+    if oid == DATE:
+        return _int32.pack((value - EPOCH.date()).days)
+    if oid == TIMESTAMP:
+        delta = value - EPOCH
+        return struct.pack('>q', (delta.days * 86400 + delta.seconds) * 1000000
+                           + delta.microseconds)
+    if oid == BYTEA:
+        return value
+    raise ValueError(u'Unsupported type oid %s' % oid)
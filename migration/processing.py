@@ -2,11 +2,16 @@ import csv
 import logging
 import os
 import shutil
-from os.path import basename, join, splitext
+from os.path import basename, join, splitext, getsize, exists
 from collections import namedtuple
+from functools import partial
+from itertools import islice, izip
 from multiprocessing import Pool
 
-from .sql_commands import upsert, setup_temp_table
+from .sql_commands import upsert, setup_temp_table, get_db_connection
+from .sql_commands import update_from_temp_table, drop_temp_table
+from . import pgbinary
+from .idmap import IdMap, DiskIdMap
 
 HERE = os.path.dirname(__file__)
 logging.basicConfig(level=logging.DEBUG)
@@ -16,26 +21,40 @@ LOG = logging.getLogger(basename(__file__))
 # See https://bitbucket.org/anybox/anybox.migration.openerp/issue/2/
 csv.field_size_limit(20971520)
 
+# kinds of operations in a compiled row transformer
+COPY, FUNCTION, MOVED, FORGET, BATCH = range(5)
+
+# number of source rows given at once to the batch mapping functions
+BATCH_SIZE = 1000
+
+# processor used by the worker processes of CSVProcessor.process_parallel
+_PROCESSOR = None
+
 
 class CSVProcessor(object):
     """ Take a csv file, process it with the mapping
     and output a new csv file
     """
-    def __init__(self, mapping, fk2update=None):
+    def __init__(self, mapping, fk2update=None, chunk_size=None, id_map_dir=None,
+                 schema_cache=None):
 
         self.fk2update = fk2update or {}  # foreign keys to update during postprocessing
         self.mapping = mapping  # mapping.Mapping instance
         self.target_columns = {}
         self.writers = {}
         self.updated_values = {}
-        self.fk_mapping = {}  # mapping for foreign keys
+        self.fk_mapping = {}  # mapping for foreign keys {table: IdMap}
         self.ref_mapping = {}  # mapping for references
         self.lines = 0
         self.is_moved = {}
-        self.existing_target_records = {}
-        self.existing_m2m_records = {}
+        self.existing_target_records = {}  # {table: {discriminator values: id}}
         self.filtered_columns = {}
         self.existing_target_columns = []
+        self.chunk_size = chunk_size  # size in bytes above which files are split in chunks
+        self.id_map_dir = id_map_dir  # directory of the DiskIdMaps, if not in memory
+        self.schema_cache = schema_cache  # caching.SchemaCache of the target database
+        self.pending = {}  # {table: source tables which may still change its fk mapping}
+        self.restored_ids = {}  # {moved table: IdMap} target ids of the previous incremental run
 
     def get_target_columns(self, filepaths, forget_missing=False, target_connection=None):
         """ Compute target columns with source columns + mapping
@@ -80,31 +99,48 @@ class CSVProcessor(object):
         If autoforget is enabled we need to explicitly specify
         which columns exist in target
         """
-        res = {}
-        for target_table in target_tables:
+        def get_columns(target_table):
             with target_connection.cursor() as c:
                 c.execute("SELECT * FROM {} LIMIT 0".format(target_table))
-                res[target_table] = [
-                    desc[0] for desc in c.description]
+                return [desc[0] for desc in c.description]
+        res = {}
+        for target_table in target_tables:
+            if self.schema_cache:
+                res[target_table] = self.schema_cache.get(
+                    ('columns', target_table), partial(get_columns, target_table))
+            else:
+                res[target_table] = get_columns(target_table)
         return res
 
 
+    def new_id_map(self):
+        """ Return an empty mapping between source and target ids,
+        stored on disk if the processor has an id_map_dir
+        """
+        if self.id_map_dir:
+            return DiskIdMap(self.id_map_dir)
+        return IdMap()
+
     def set_existing_data(self, existing_records):
-        """let the existing data be accessible during processing
-        """
-        self.existing_target_records = existing_records
-        # the same without ids
-        # WTF?
-        self.existing_m2m_records = {
-            table: [{k: str(v) for k, v in nt.iteritems() if k != 'id'} for nt in existing]
-            for table, existing in existing_records.iteritems()
-        }
+        """let the existing data be accessible during processing.
+        Existing records are indexed by the tuple of their discriminator
+        values (as strings), and the index gives the id of the record
+        (None for m2m tables), so that matching a row is a dict lookup
+        """
+        self.existing_target_records = {}
+        for table, existing in existing_records.iteritems():
+            discriminators = self.mapping.discriminators.get(table) or sorted(
+                k for k in (existing[0].keys() if existing else ()) if k != 'id')
+            index = self.existing_target_records[table] = {}
+            for nt in existing:
+                key = tuple(str(nt[d]) for d in discriminators)
+                # keep the first existing record if several ones match
+                if key not in index:
+                    index[key] = nt.get('id')
 
-    def reorder_with_discriminators(self, tables):
-        """ Reorder the filepaths based on tables pointed by discriminators
-        (if they are fk)
+    def get_discriminator_tables(self, tables):
+        """ Return the set of tables pointed by discriminators (if they are fk)
         """
-        # get the list of tables pointed by discriminators
         discriminator_tables = set()
         for table, columns in self.mapping.discriminators.iteritems():
             for column in columns:
@@ -114,6 +150,14 @@ class CSVProcessor(object):
         #special handling to ensure ir.property is last
         if 'ir_property' in tables:
             discriminator_tables.add('ir_property')
+        return discriminator_tables
+
+    def reorder_with_discriminators(self, tables):
+        """ Reorder the filepaths based on tables pointed by discriminators
+        (if they are fk)
+        """
+        # get the list of tables pointed by discriminators
+        discriminator_tables = self.get_discriminator_tables(tables)
         # remove them from the initial tables
         tables = [t for t in tables if t not in discriminator_tables]
         # reorder the small set with a very basic algorithm:
@@ -136,8 +180,12 @@ class CSVProcessor(object):
         return ordered_tables
 
     def process(self, source_dir, source_filenames, target_dir,
-                target_connection=None, del_csv=False):
+                target_connection=None, del_csv=False, processes=1,
+                single_pass=False):
         """ The main processing method
+        With several processes, independent source tables are processed
+        in parallel (see process_parallel), and so are the postprocessed files
+        With single_pass, see process_single_pass
         """
         # compute the target columns
         filepaths = [join(source_dir, source_filename) for source_filename in source_filenames]
@@ -151,28 +199,11 @@ class CSVProcessor(object):
             table: join(target_dir, table + '.target.csv')
             for table in self.target_columns
         }
-        target_files = {
-            table: open(filename, 'ab')
-            for table, filename in target_filenames.items()
-        }
-        self.writers = {t: csv.DictWriter(f, self.target_columns[t], delimiter=',')
-                        for t, f in target_files.items()}
-        for writer in self.writers.values():
-            writer.writeheader()
-
         # update filenames and files
         update_filenames = {
             table: join(target_dir, table + '.update.csv')
             for table in self.target_columns
         }
-        update_files = {
-            table: open(filename, 'ab')
-            for table, filename in update_filenames.items()
-        }
-        self.updatewriters = {t: csv.DictWriter(f, self.target_columns[t], delimiter=',')
-                              for t, f in update_files.items()}
-        for writer in self.updatewriters.values():
-            writer.writeheader()
         LOG.info(u"Processing CSV files...")
         # We should first reorder the processing so that tables pointed to by
         # discriminator values which are fk be processed first. This is not the
@@ -180,8 +211,20 @@ class CSVProcessor(object):
         # leading to unwanted matching and unwanted merge.
         ordered_tables = self.reorder_with_discriminators(source_tables)
         ordered_paths = [join(source_dir, table + '.csv') for table in ordered_tables]
-        for source_filepath in ordered_paths:
-            self.process_one(source_filepath, target_connection)
+        if single_pass:
+            if processes > 1:
+                LOG.warning(u"Single pass processing is done in a single process")
+            self.process_single_pass(source_dir, ordered_tables, target_dir)
+        else:
+            # write the headers, rows are appended by process_tables
+            for table in self.target_columns:
+                for filename in (target_filenames[table], update_filenames[table]):
+                    with open(filename, 'ab') as f:
+                        csv.DictWriter(f, self.target_columns[table], delimiter=',').writeheader()
+            if processes > 1:
+                self.process_parallel(source_dir, ordered_tables, target_dir, processes)
+            else:
+                self.process_tables(source_dir, ordered_tables, target_dir)
 
         #Delete Files to free up RAM on tmpfs
         if del_csv:
@@ -189,26 +232,11 @@ class CSVProcessor(object):
                 map(os.remove, ordered_paths)
             except os.error:
                 LOG.warning(u"Couldn't remove CSV Files")
-        # close files
-        [f.close() for f in target_files.values() + update_files.values()]
+        if single_pass:
+            return
 
-        # POSTPROCESS target filenames and files
-        target2_filenames = {
-            table: join(target_dir, table + '.target2.csv')
-            for table in self.target_columns
-        }
-        target2_files = {
-            table: open(filename, 'ab')
-            for table, filename in target2_filenames.items()
-        }
-        self.writers = {t: csv.DictWriter(f, self.target_columns[t], delimiter=',')
-                        for t, f in target2_files.items()}
-        for writer in self.writers.values():
-            writer.writeheader()
         LOG.info(u"Postprocessing CSV files...")
-        for filename in target_filenames.values():
-            filepath = join(target_dir, filename)
-            self.postprocess_one(filepath)
+        self.postprocess(target_filenames, '.target2.csv', target_dir, processes)
 
         # Delete files to free up RAM on tmpfs
         if del_csv:
@@ -217,31 +245,598 @@ class CSVProcessor(object):
             except os.error:
                 LOG.warning(u"Couldn't remove target CSV Files")
 
-        [f.close() for f in target2_files.values()]
+        self.postprocess(update_filenames, '.update2.csv', target_dir, processes)
 
-        # POSTPROCESS update filenames and files
-        update2_filenames = {
-            table: join(target_dir, table + '.update2.csv')
-            for table in self.target_columns
-        }
-        update2_files = {
-            table: open(filename, 'ab')
-            for table, filename in update2_filenames.items()
-        }
-        self.writers = {t: csv.DictWriter(f, self.target_columns[t], delimiter=',')
-                        for t, f in update2_files.items()}
-        for writer in self.writers.values():
-            writer.writeheader()
-        for filename in update_filenames.values():
-            filepath = join(target_dir, filename)
-            self.postprocess_one(filepath)
-        # close files
-        for f in update2_files.values():
-            f.close()
+    def postprocess(self, filenames, suffix, target_dir, processes=1):
+        """ Postprocess the target or update file of each table into a new
+        file with the given suffix. The mappings are read-only at this point,
+        so with several processes the files are postprocessed in parallel by
+        forked workers sharing them, and files bigger than chunk_size are
+        split in chunks
+        """
+        global _PROCESSOR
+        outputs = {table: join(target_dir, table + suffix) for table in self.target_columns}
+        for table, output in outputs.items():
+            with open(output, 'ab') as f:
+                csv.DictWriter(f, self.target_columns[table], delimiter=',').writeheader()
+        if processes <= 1:
+            files = {table: open(output, 'ab') for table, output in outputs.items()}
+            self.writers = {t: csv.DictWriter(f, self.target_columns[t], delimiter=',')
+                            for t, f in files.items()}
+            try:
+                for filepath in filenames.values():
+                    self.postprocess_one(filepath)
+            finally:
+                for f in files.values():
+                    f.close()
+            return
+
+        tasks, parts = [], {}
+        for table, filepath in filenames.items():
+            if self.chunk_size and getsize(filepath) > self.chunk_size:
+                chunks = split_csv(filepath, self.chunk_size)
+                LOG.info(u"Postprocessing %s in %s chunks", basename(filepath), len(chunks))
+                parts[table] = ['%s.%s' % (outputs[table], i) for i in range(len(chunks))]
+                tasks += [(end - start, filepath, (start, end), part)
+                          for (start, end, _), part in zip(chunks, parts[table])]
+            else:
+                tasks.append((getsize(filepath), filepath, None, outputs[table]))
+        # biggest first
+        tasks.sort(reverse=True)
+        _PROCESSOR = self
+        pool = Pool(processes)
+        try:
+            pool.map(_postprocess_file, [task[1:] for task in tasks], 1)
+        finally:
+            pool.close()
+            pool.join()
+            _PROCESSOR = None
+        for table, part_filenames in parts.items():
+            with open(outputs[table], 'ab') as f:
+                append_parts(f, part_filenames)
+
+    def process_single_pass(self, source_dir, ordered_tables, target_dir):
+        """ Process and postprocess the source tables in a single pass, without
+        writing and reading back the .target.csv and .update.csv files.
+        A row is postprocessed as soon as it is processed if no remaining
+        source table may change the fk mapping of the tables it points to.
+        The other rows are spilled in .target-spill.csv and .update-spill.csv
+        files, postprocessed at the end
+        """
+        self.pending = self.get_pending_tables(source_dir, ordered_tables)
+        files, writers = [], {'target': {}, 'update': {}}
+        for table, columns in self.target_columns.items():
+            for kind in ('target', 'update'):
+                f = open(join(target_dir, '%s.%s2.csv' % (table, kind)), 'ab')
+                spill = open(join(target_dir, '%s.%s-spill.csv' % (table, kind)), 'wb')
+                files += [f, spill]
+                writer = csv.DictWriter(f, columns, delimiter=',')
+                spill_writer = csv.DictWriter(spill, columns, delimiter=',')
+                writer.writeheader()
+                spill_writer.writeheader()
+                writers[kind][table] = SinglePassWriter(
+                    self, table, writer, spill_writer, update=kind == 'update')
+        self.writers, self.updatewriters = writers['target'], writers['update']
+        try:
+            for source_table in ordered_tables:
+                self.process_one(join(source_dir, source_table + '.csv'))
+                for sources in self.pending.values():
+                    sources.discard(source_table)
+                self.pending = {t: s for t, s in self.pending.items() if s}
+        finally:
+            for f in files:
+                f.close()
+
+        # every fk can be fixed now
+        self.pending = {}
+        for kind in ('target', 'update'):
+            spilled = sum(w.spilled for w in writers[kind].values())
+            LOG.info(u"Postprocessing %s spilled %s rows...", spilled, kind)
+            files = {
+                table: open(join(target_dir, '%s.%s2.csv' % (table, kind)), 'ab')
+                for table in self.target_columns
+            }
+            self.writers = {t: csv.DictWriter(f, self.target_columns[t], delimiter=',')
+                            for t, f in files.items()}
+            try:
+                for table in self.target_columns:
+                    spill_filename = join(target_dir, '%s.%s-spill.csv' % (table, kind))
+                    self.postprocess_one(spill_filename)
+                    os.remove(spill_filename)
+            finally:
+                for f in files.values():
+                    f.close()
+
+    def get_pending_tables(self, source_dir, source_tables):
+        """ Return the source tables which may change the fk mapping of each
+        table: moved tables change their own mapping, and source tables matching
+        existing records change the mapping of their target tables
+        """
+        pending = {}
+        for source_table in source_tables:
+            with open(join(source_dir, source_table + '.csv'), 'rb') as f:
+                header = csv.reader([f.readline()]).next()
+            for target_table in self.compile_transform(source_table, header).tables:
+                if self.existing_target_records.get(target_table):
+                    pending.setdefault(target_table, set()).add(source_table)
+            if source_table in self.is_moved:
+                pending.setdefault(source_table, set()).add(source_table)
+        return pending
+
+    def get_streamable_tables(self, source_dir, source_tables):
+        """ Return the source tables which can be streamed from the source to
+        the target database without csv files (see streaming.py). Their rows
+        must not change the fk mapping used by other tables, nor be updates,
+        so moved tables and those feeding target tables with existing records
+        or deferred columns can't be streamed
+        """
+        streamable = []
+        discriminator_tables = self.get_discriminator_tables(source_tables)
+        for source_table in source_tables:
+            if source_table in discriminator_tables:
+                continue
+            with open(join(source_dir, source_table + '.csv'), 'rb') as f:
+                header = csv.reader([f.readline()]).next()
+            transform = self.compile_transform(source_table, header)
+            if source_table in self.is_moved:
+                continue
+            if any(self.existing_target_records.get(t) or t in self.mapping.deferred
+                   for t in transform.tables):
+                continue
+            streamable.append(source_table)
+        return streamable
+
+    def get_binary_tables(self, source_dir, source_tables, source_types, target_types):
+        """ Return {source table: target table} for the source tables which can
+        be migrated with binary COPY data (see compile_binary_transform):
+        their mapping only copies columns to the same columns of a single target
+        table, without functions, references or moved ids, the columns have the
+        same types in both databases, and the id and foreign keys are integers.
+        source_tables should be streamable (see get_streamable_tables).
+        The types are given as {table: {column: type oid}}
+        """
+        binary_tables = {}
+        for source_table in source_tables:
+            with open(join(source_dir, source_table + '.csv'), 'rb') as f:
+                header = csv.reader([f.readline()]).next()
+            transform = self.compile_transform(source_table, header)
+            if len(transform.tables) != 1 or not transform.plan:
+                continue
+            target_table = transform.tables[0]
+            source_columns = source_types.get(source_table, {})
+            target_columns = target_types.get(target_table, {})
+            for kind, source_column, _, target_column, _ in transform.plan:
+                target_record = target_table + '.' + target_column
+                if (kind != COPY or source_column != target_column
+                        or target_record in self.ref_mapping
+                        or target_column not in target_columns
+                        or source_columns.get(source_column) != target_columns[target_column]
+                        or ((target_column == 'id' or target_record in self.fk2update)
+                            and target_columns[target_column] not in pgbinary.INTEGERS)):
+                    break
+            else:
+                if not all(c in target_columns for c in self.target_columns[target_table]):
+                    continue
+                # the offset ids and fks must fit in their integer columns,
+                # otherwise the table is processed as csv like the others
+                if all(self.get_max_binary_int(source_table, target_table, c)
+                       <= pgbinary.MAX_INTS[target_columns[c]]
+                       for _, _, _, c, _ in transform.plan
+                       if c == 'id' or target_table + '.' + c in self.fk2update):
+                    binary_tables[source_table] = target_table
+        return binary_tables
+
+    def get_max_binary_int(self, source_table, target_table, column):
+        """ Return the highest value the offset id or foreign key of a column
+        of a binary table can take, or infinity if it is not known
+        """
+        max_source_id, max_target_id = self.mapping.max_source_id, self.mapping.max_target_id
+
+        def target_id(table, source_id):
+            if table not in max_target_id:
+                return source_id
+            return self.mapping.target_id(table, source_id)
+
+        if column == 'id':
+            if source_table not in max_source_id:
+                return float('inf')
+            return target_id(target_table, max_source_id[source_table])
+        fk_table = self.fk2update[target_table + '.' + column]
+        if fk_table not in max_source_id:
+            return float('inf')
+        moved = self.is_moved.get(fk_table, fk_table)
+        value = target_id(moved, max_source_id[fk_table])
+        if fk_table in self.is_moved:
+            # the moved rows take new ids after those of the table
+            value += self.mapping.new_id.get(moved, 0)
+        return value
+
+    def compile_binary_transform(self, source_table, target_table, source_columns):
+        """ Return a function converting a row of binary COPY data of a source
+        table returned by get_binary_tables into a row for the columns of the
+        target table, or None if the row must not be written. The other columns
+        are passed through, only the id and the foreign keys are decoded to be
+        offset and fixed like process_rows and postprocess_row would do
+        """
+        plan = self.compile_transform(source_table, source_columns).plan
+        columns = [p[3] for p in plan]
+        positions = [columns.index(c) if c in columns else None
+                     for c in self.target_columns[target_table]]
+        id_index = columns.index('id') if 'id' in columns else None
+        fks = [(i, self.fk2update[target_table + '.' + c]) for i, c in enumerate(columns)
+               if target_table + '.' + c in self.fk2update]
+        fk_mapping, is_moved = self.fk_mapping, self.is_moved
+        target_id = self.mapping.target_id
+        decode_int, encode_int = pgbinary.decode_int, pgbinary.encode_int
+        indexes = [source_columns.index(c) for c in columns]
+
+        def transform(source_row):
+            row = [source_row[i] for i in indexes]
+            if not any(row):
+                return None
+            if id_index is not None:
+                value = row[id_index]
+                row[id_index] = encode_int(target_id(target_table, decode_int(value)),
+                                           len(value))
+            elif len(row) == 2 and not all(row):
+                # don't write incomplete m2m
+                return None
+            for i, fk_table in fks:
+                value = row[i]
+                if value is not None:
+                    value = decode_int(value)
+                    # 0 is not a reference, like in postprocess_row
+                    if value:
+                        value = fk_mapping.get(fk_table, {}).get(
+                            value, target_id(is_moved.get(fk_table, fk_table), value))
+                        row[i] = encode_int(value, len(row[i]))
+            return [None if p is None else row[p] for p in positions]
+
+        return transform
+
+    def process_binary(self, source_dir, binary_tables, target_dir):
+        """ Convert the binary COPY files of the source tables returned by
+        get_binary_tables into a <target>.target2.bin file for each target table.
+        This must be done after processing the other tables, once the fk
+        mapping is complete. The column names are read from the csv header
+        of each source table
+        """
+        files, writers = {}, {}
+        try:
+            for source_table, target_table in sorted(binary_tables.items()):
+                if target_table not in writers:
+                    files[target_table] = open(
+                        join(target_dir, target_table + '.target2.bin'), 'wb')
+                    writers[target_table] = pgbinary.BinaryWriter(files[target_table])
+                writer = writers[target_table]
+                with open(join(source_dir, source_table + '.csv'), 'rb') as f:
+                    header = csv.reader([f.readline()]).next()
+                transform = self.compile_binary_transform(source_table, target_table, header)
+                with open(join(source_dir, source_table + '.bin'), 'rb') as f:
+                    for source_row in pgbinary.read_rows(f):
+                        self.lines += 1
+                        target_row = transform(source_row)
+                        if target_row is not None:
+                            writer.writerow(target_row)
+            for writer in writers.values():
+                writer.close()
+        finally:
+            for f in files.values():
+                f.close()
+
+    def process_tables(self, source_dir, source_tables, target_dir, target_tables=None):
+        """ Process the source tables one after the other, appending the rows
+        to the target and update files of the target tables
+        """
+        if not source_tables:
+            return
+        if target_tables is None:
+            target_tables = self.target_columns
+        files = self.open_writers(target_dir, target_tables)
+        try:
+            for source_table in source_tables:
+                self.process_one(join(source_dir, source_table + '.csv'))
+        finally:
+            for f in files:
+                f.close()
+
+    def open_writers(self, target_dir, target_tables, part=None):
+        """ Open the target and update files of the target tables for writing
+        and return the open files. The rows are appended to the files, or
+        written in new part files (without header) if a part number is given
+        """
+        files = []
+        self.writers, self.updatewriters = {}, {}
+        for table in target_tables:
+            for writers, suffix in ((self.writers, '.target.csv'),
+                                    (self.updatewriters, '.update.csv')):
+                filename = join(target_dir, table + suffix)
+                if part is None:
+                    f = open(filename, 'ab')
+                else:
+                    f = open('%s.%s' % (filename, part), 'wb')
+                files.append(f)
+                writers[table] = csv.DictWriter(f, self.target_columns[table], delimiter=',')
+        return files
+
+    def process_parallel(self, source_dir, ordered_tables, target_dir, processes):
+        """ Process the source tables with a pool of worker processes.
+        Tables pointed by fk discriminators, tables whose mapping calls sql()
+        and ir_property are still processed in order in this process. The
+        other tables are grouped when they share a target table, so that each
+        target file and each new_id counter is only fed by a single worker.
+        The state of the workers is then merged back before postprocessing
+        """
+        global _PROCESSOR
+        discriminator_tables = self.get_discriminator_tables(ordered_tables)
+        first = [t for t in ordered_tables
+                 if (t in discriminator_tables and t != 'ir_property')
+                 or self.has_sql_functions(t)]
+        last = [t for t in ordered_tables if t == 'ir_property']
+        independent = [t for t in ordered_tables if t not in first and t not in last]
+        # big tables are processed afterwards, split in chunks
+        chunked = [t for t in independent if self.chunk_size
+                   and getsize(join(source_dir, t + '.csv')) > self.chunk_size]
+        independent = [t for t in independent if t not in chunked]
+        self.process_tables(source_dir, first, target_dir)
+
+        groups = self.group_by_targets(source_dir, independent)
+        workers = min(processes, len(groups))
+        if workers > 1:
+            LOG.info(u"Processing %s groups of tables with %s processes",
+                     len(groups), workers)
+            # the workers are forked and get the processor through this global
+            _PROCESSOR = self
+            pool = Pool(workers, initializer=_init_worker)
+            try:
+                results = pool.map(
+                    _process_group,
+                    [(source_dir, tables, target_dir, targets) for tables, targets in groups],
+                    1)
+            finally:
+                pool.close()
+                pool.join()
+                _PROCESSOR = None
+            self.merge_state(results)
+        else:
+            self.process_tables(source_dir, independent, target_dir)
+
+        if chunked:
+            self.process_chunked(source_dir, chunked, target_dir, processes)
+        self.process_tables(source_dir, last, target_dir)
+
+    def process_chunked(self, source_dir, source_tables, target_dir, processes):
+        """ Process big source tables one after the other, each one being
+        split in chunks processed in parallel. Each chunk gets its own range of
+        new ids of the target tables, reserved from the number of lines of the
+        previous chunks, and writes its own part files. The parts are appended
+        in order to the target and update files and the states of the chunks
+        are merged in order, so that the result doesn't depend on the scheduling.
+        If a chunk allocates more new ids than reserved, or new ids of other
+        tables, the parts are dropped and the table is processed unchunked
+        """
+        global _PROCESSOR
+        _PROCESSOR = self
+        pool = Pool(processes, initializer=_init_worker)
+        try:
+            for source_table in source_tables:
+                source_filepath = join(source_dir, source_table + '.csv')
+                with open(source_filepath, 'rb') as f:
+                    header = csv.reader([f.readline()]).next()
+                # number of new ids allocated for each line
+                newids = self.compile_transform(source_table, header).newids
+                target_tables = self.get_source_targets(source_filepath)
+                chunks = split_csv(source_filepath, self.chunk_size)
+                LOG.info(u"Processing %s in %s chunks", source_table, len(chunks))
+                tasks, offset = [], 0
+                for index, (start, end, lines) in enumerate(chunks):
+                    new_id = {t: i + offset if t in target_tables else i
+                              for t, i in self.mapping.new_id.iteritems()}
+                    tasks.append((source_filepath, index, (start, end), target_dir,
+                                  target_tables, new_id, lines * newids))
+                    offset += lines * newids
+                results = pool.map(_process_chunk, tasks, 1)
+                if None in results:
+                    LOG.warn(u'Processing %s again without chunks, as its chunks '
+                             u'allocated more new ids than reserved', source_table)
+                    for table in target_tables:
+                        for suffix in ('.target.csv', '.update.csv'):
+                            for i in range(len(chunks)):
+                                os.remove(join(target_dir, '%s%s.%s' % (table, suffix, i)))
+                    self.process_tables(source_dir, [source_table], target_dir, target_tables)
+                    continue
+                for table in target_tables:
+                    for suffix in ('.target.csv', '.update.csv'):
+                        filename = join(target_dir, table + suffix)
+                        with open(filename, 'ab') as f:
+                            append_parts(f, ['%s.%s' % (filename, i) for i in range(len(chunks))])
+                self.merge_state(results, shared_ids=True)
+        finally:
+            pool.close()
+            pool.join()
+            _PROCESSOR = None
+
+    def merge_state(self, results, shared_ids=False):
+        """ Merge back the state returned by the workers of process_parallel.
+        With shared_ids, the workers allocated new ids of the same tables in
+        reserved ranges, and we keep the highest ones
+        """
+        advanced = {}
+        for lines, fk_mapping, is_moved, ref_mapping, new_id, fk_lookup_stats in results:
+            self.lines += lines
+            self.mapping.merge_fk_lookup_stats(fk_lookup_stats)
+            for table, ids in fk_mapping.iteritems():
+                if table in self.fk_mapping:
+                    self.fk_mapping[table].update(ids)
+                else:
+                    self.fk_mapping[table] = ids
+            self.is_moved.update(is_moved)
+            self.ref_mapping.update(ref_mapping)
+            for table, value in new_id.iteritems():
+                if table in advanced and not shared_ids:
+                    LOG.error(u'new ids of %s were allocated by several processes, '
+                              u'they may collide', table)
+                advanced[table] = max(value, advanced.get(table, value))
+        self.mapping.new_id.update(advanced)
+
+    def get_source_targets(self, source_filepath):
+        """ Return the set of target tables fed by a source csv file
+        """
+        source_table = basename(source_filepath).rsplit('.', 1)[0]
+        with open(source_filepath) as f:
+            source_columns = csv.reader(f).next()
+        targets = set()
+        for source_column in source_columns + ['_']:
+            mapping = self.mapping.get_target_column(source_table, source_column)
+            for target in (mapping or ()):
+                targets.add(target.split('.')[0])
+        return targets
+
+    def group_by_targets(self, source_dir, source_tables):
+        """ Group the source tables sharing a target table.
+        Return a list of (source tables, target tables), biggest groups first
+        """
+        groups = []
+        for source_table in source_tables:
+            source_filepath = join(source_dir, source_table + '.csv')
+            tables, targets = [source_table], self.get_source_targets(source_filepath)
+            for group in [g for g in groups if g[1] & targets]:
+                groups.remove(group)
+                tables = group[0] + tables
+                targets |= group[1]
+            groups.append((tables, targets))
+        size = lambda group: sum(getsize(join(source_dir, t + '.csv')) for t in group[0])
+        return sorted(groups, key=size, reverse=True)
+
+    def has_sql_functions(self, source_table):
+        """ Return True if a mapping function of the source table calls sql().
+        Such tables may write in the databases, so they are not processed
+        in a worker process with its own connection
+        """
+        self.mapping.compile_table(source_table)
+        for source_column, targets in self.mapping.mapping.iteritems():
+            if source_column.split('.')[0] != source_table:
+                continue
+            for function in targets.values():
+                if callable(function) and 'sql' in function.func_code.co_names:
+                    return True
+        return False
+
+    def compile_transform(self, source_table, source_columns):
+        """ Compile the mapping of a source table into a row transformer.
+        Mapping lookups, wildcards and special statements are resolved once
+        for the csv header, so the returned function only does the data work:
+        it takes a source row and returns the dict of target rows.
+        If the mapping has batch functions, transform.batch(source_rows) returns
+        their values for each row of a block, and they must be given to
+        transform(source_row, values) (see transform_rows)
+        """
+        get_targets = self.mapping.get_target_column
+        # iterate the columns in the same order as a csv.DictReader row
+        # (with the '_' column), so that functions writing in target_rows
+        # are applied in the same order as before
+        columns = dict(zip(source_columns, source_columns))
+        columns.update({'_': None})
+        tables = []  # target tables, in the order they are met
+        plan = []  # flat list of (kind, source column, target table, target column, function)
+        for source_column in columns:
+            mapping = get_targets(source_table, source_column)
+            if mapping is None:  # if the column isn't mapped we forget about it
+                continue
+            for target_record, function in mapping.items():
+                target_table, target_column = target_record.split('.')
+                if target_table not in tables:
+                    tables.append(target_table)
+                # We deal with forgotten columns here
+                if self.existing_target_columns and (
+                        target_column not in self.existing_target_columns[target_table]):
+                    continue
+                if target_column == '_':
+                    continue
+                if function in (None, '__copy__'):
+                    plan.append((COPY, source_column, target_table, target_column, None))
+                elif type(function) is str and function.startswith('__ref__'):
+                    # copy the value, the reference is fixed during postprocessing
+                    plan.append((COPY, source_column, target_table, target_column, None))
+                    self.ref_mapping[target_record] = function.split()[1]
+                elif function in (False, '__forget__'):
+                    plan.append((FORGET, source_column, target_table, target_column, None))
+                elif function == '__moved__':
+                    # in case the id has moved to a new record,
+                    # we should save the mapping to correctly fix fks
+                    # This can happen in case of semantic change like res.partner.address
+                    self.is_moved.setdefault(source_table, target_table)
+                    if source_table not in self.fk_mapping:
+                        self.fk_mapping[source_table] = self.new_id_map()
+                    plan.append((MOVED, source_column, target_table, target_column, None))
+                elif getattr(function, 'batch', False):
+                    plan.append((BATCH, source_column, target_table, target_column, function))
+                else:
+                    # mapping is supposed to be a function
+                    plan.append((FUNCTION, source_column, target_table, target_column, function))
+
+        newid, target_id = self.mapping.newid, self.mapping.target_id
+        moved_mapping = self.fk_mapping.get(source_table)
+        restored = self.restored_ids.get(source_table)
+
+        def transform(source_row, batch_values=()):
+            target_rows = {table: {} for table in tables}
+            batch_values = iter(batch_values)
+            for kind, source_column, target_table, target_column, function in plan:
+                if kind == COPY:
+                    target_rows[target_table][target_column] = source_row.get(source_column)
+                elif kind == FUNCTION or kind == BATCH:
+                    if kind == FUNCTION:
+                        result = function(self, source_row, target_rows)
+                    else:
+                        result = next(batch_values)
+                    if result == '__forget_row__':
+                        target_rows[target_table]['__forget_row__'] = True
+                    target_rows[target_table][target_column] = result
+                elif kind == MOVED:
+                    # the target id is final, process_rows doesn't offset it
+                    source_id = int(source_row[source_column])
+                    if restored is not None and source_id in restored:
+                        # keep the id given by a previous incremental run
+                        new_id = restored[source_id]
+                    else:
+                        new_id = target_id(target_table, newid(target_table))
+                    target_rows[target_table][target_column] = new_id
+                    # so fk_mapping looks like {'mail_alias': {1: 100}
+                    moved_mapping[source_id] = new_id
+                else:
+                    # mapping is False: remove the target column
+                    target_rows[target_table].pop(target_column, None)
+            return target_rows
+
+        batch_functions = [(p[1], p[4]) for p in plan if p[0] == BATCH]
+
+        def batch(source_rows):
+            columns = BatchColumns(source_rows)
+            results = []
+            for source_column, function in batch_functions:
+                result = list(function(self, source_rows, columns))
+                if len(result) != len(source_rows):
+                    raise ValueError(u'The batch function of %s.%s returned %s values '
+                                     u'for %s rows' % (source_table, source_column,
+                                                       len(result), len(source_rows)))
+                results.append(result)
+            return zip(*results)
+
+        transform.tables = tables
+        transform.plan = plan
+        transform.batch = batch_functions and batch
+        # target tables whose ids are given by __moved__, already offset
+        transform.moved = set(p[2] for p in plan if p[0] == MOVED and p[3] == 'id')
+        # number of new ids allocated for each row (see process_chunked)
+        transform.newids = len([
+            p for p in plan if p[0] == MOVED
+            or (p[0] in (FUNCTION, BATCH) and 'newid' in p[4].func_code.co_names)])
+        return transform
 
     def process_one(self, source_filepath,
-                    target_connection=None):
-        """ Process one csv file
+                    target_connection=None, chunk=None):
+        """ Process one csv file, or only the (start, end) byte range of a chunk
         The fk_mapping should not be read in this method. Only during postprocessing,
         Because the processing order is not determined (unordered dicts)
         """
@@ -249,233 +844,561 @@ class CSVProcessor(object):
         #processing needs to go through a number of steps
 
         source_table = basename(source_filepath).rsplit('.', 1)[0]
-        get_targets = self.mapping.get_target_column
 
         # here we process the source csv
         with open(source_filepath, 'rb') as source_csv: #we start with the raw data and open it
-            reader = csv.DictReader(source_csv, delimiter=',')
-            # process each csv line
-            for source_row in reader: # then iterate the rows
-                self.lines += 1
-                target_rows = {}
-                # process each column (also handle '_' as a possible new column)
-                source_row.update({'_': None})
-                for source_column in source_row: # dict like {'id': 1, 'create_uid': 1, 'name': 'gay'}
-                    mapping = get_targets(source_table, source_column)
-                    if mapping is None: # if the column isn't mapped we forget about it
-                        continue
-                    # we found a mapping, use it
-                    # for every record we must first process any columns functions to transform the data
-                    for target_record, function in mapping.items(): # This holds what we need to do
-                        target_table, target_column = target_record.split('.')
-                        target_rows.setdefault(target_table, {}) # create a dictionary for the rows using the table as key
-
-                        # We deal with forgotten columns here
-                        if self.existing_target_columns and (
-                                    target_column not in
-                                    self.existing_target_columns[target_table]):
-                            continue
-
-                        if target_column == '_': # if its a new column to feed we move on, this makes no sense?
-                            continue
-                        #next we handle special indicators
-                        if function in (None, '__copy__'): # copy it
-                            # mapping is None: use identity
-                            target_rows[target_table][target_column] = source_row[source_column]
-                        elif type(function) is str and function.startswith('__ref__'): # use another field
-                            target_rows[target_table][target_column] = source_row[source_column]
-                            model_column = function.split()[1]
-                            self.ref_mapping[target_record] = model_column # what? for every row, no way, this can be done way earlier
-
-                        elif function in (False, '__forget__'): # for this column we forget about it - obvious - but why do we need to do it every time?
-                            # mapping is False: remove the target column
-                            del target_rows[target_table][target_column]
-                        # in case the id has moved to a new record,
-                        # we should save the mapping to correctly fix fks
-                        # This can happen in case of semantic change like res.partner.address
-                        elif function == '__moved__':
-                            source_table not in self.is_moved and self.is_moved.update({source_table: target_table}) # store that it has moved
-                            newid = self.mapping.newid(target_table) # give it a new database_id
-                            target_rows[target_table][target_column] = newid
-                            self.fk_mapping.setdefault(source_table, {})
-                            self.fk_mapping[source_table][int(source_row[source_column])] = newid + self.mapping.max_target_id[target_table] # so fk_mapping looks like {'mail_alias': {1: 100}
-                        else:
-                            # mapping is supposed to be a function
-                            result = function(self, source_row, target_rows) #run the compiled function
-                            if result == '__forget_row__':
-                                target_rows[target_table]['__forget_row__'] = True
-                            target_rows[target_table][target_column] = result
-
-                # now our target_row is set write it
-                # offset all ids except existing data and choose to write now or update later
-                # forget any rows that are being filtered
-                for table, target_row in target_rows.items():
-                    if '__forget_row__' in target_row:
-                        continue
-                    if not any(target_row.values()):
+            self.process_rows(source_table, dict_reader(source_csv, chunk))
+
+    def process_rows(self, source_table, reader):
+        """ Process the rows given by a csv.DictReader on a source table
+        """
+        transform = self.compile_transform(source_table, reader.fieldnames or [])
+        # process each csv line
+        for source_row, target_rows in transform_rows(transform, reader): # then iterate the rows
+            self.lines += 1
+
+            # now our target_row is set write it
+            # offset all ids except existing data and choose to write now or update later
+            # forget any rows that are being filtered
+            for table, target_row in target_rows.items():
+                if '__forget_row__' in target_row:
+                    continue
+                if not any(target_row.values()):
+                    continue
+                # here we handle collisions with existing data
+                discriminators = self.mapping.discriminators.get(table) # list of field names
+                # if the line exists in the target db, we don't offset and write to update file
+                # (we recognize by matching the dict of discriminator values against existing)
+                existing = self.existing_target_records.get(table, {})
+                match_values = {d: target_row[d] for d in (discriminators or [])} # a dict with column: write
+
+                # before matching existing, we should fix the discriminator_values which are fk
+                # FIXME refactor and merge with the code in postprocess
+                # GG Move this, only concerned with foreign keys
+                for column, value in match_values.items():
+                    fk_table = self.fk2update.get(table + '.' + column)
+                    if value and fk_table:
+                        value = int(value)
+                        # this is BROKEN because it needs the fk_table to be processed before.
+                        if value in self.fk_mapping.get(fk_table, []):
+                            match_values[column] = str(
+                                self.fk_mapping[fk_table].get(value, value))
+
+                # save the mapping between source id and existing id
+
+                match_key = tuple(str(match_values[d]) for d in (discriminators or []))
+                if (discriminators
+                        and 'id' in target_row
+                        and all(match_values.values())
+                        and match_key in existing):
+                    # the id of the existing record in the target
+                    existing_id = existing[match_key]
+                    if table not in self.fk_mapping:
+                        self.fk_mapping[table] = self.new_id_map()
+                        # we save the match between source and existing id
+                        # to be able to update the fks in the 2nd pass
+                    self.fk_mapping[table][int(target_row['id'])] = existing_id
+
+                # fix fk to a moved table with existing data
+                    if source_table in self.is_moved:
+                        source_id = int(source_row['id'])
+                        if source_id in self.fk_mapping[source_table]:
+                            target_row['id'] = existing_id
+                            self.fk_mapping[source_table][source_id] = existing_id
+
+                    self.updatewriters[table].writerow(target_row)
+                else:
+                    # offset the id of the line, except for m2m (no id)
+                    if 'id' in target_row:
+                        if table not in transform.moved:
+                            target_row['id'] = str(self.mapping.target_id(table, int(target_row['id'])))
+                        # handle deferred records
+                        if table in self.mapping.deferred:
+                            upd_row = {k: v for k, v in target_row.iteritems()
+                                       if k == 'id'
+                                       or (k in self.mapping.deferred[table] and v != '')}
+                            if len(upd_row) > 1:
+                                self.updatewriters[table].writerow(upd_row)
+                            for k in self.mapping.deferred[table]:
+                                if k in target_row:
+                                    del target_row[k]
+                    # don't write incomplete m2m
+                    if ('id' not in target_row
+                            and len(target_row) == 2
+                            and not all(target_row.values())):
                         continue
-                    # here we handle collisions with existing data
-                    discriminators = self.mapping.discriminators.get(table) # list of field names
-                    # if the line exists in the target db, we don't offset and write to update file
-                    # (we recognize by matching the dict of discriminator values against existing)
-                    existing = self.existing_target_records.get(table, []) #get all the existing db_values that have an id field (see exporting.py)
-                    existing_without_id = self.existing_m2m_records.get(table, []) #get m2m fields
-                    match_values = {d: target_row[d] for d in (discriminators or [])} # a dict with column: write
-
-                    # before matching existing, we should fix the discriminator_values which are fk
-                    # FIXME refactor and merge with the code in postprocess
-                    # GG Move this, only concerned with foreign keys
-                    for column, value in match_values.items():
-                        fk_table = self.fk2update.get(table + '.' + column)
-                        if value and fk_table:
-                            value = int(value)
-                            # this is BROKEN because it needs the fk_table to be processed before.
-                            if value in self.fk_mapping.get(fk_table, []):
-                                match_values[column] = str(
-                                    self.fk_mapping[fk_table].get(value, value))
-
-                    # save the mapping between source id and existing id
-
-                    if (discriminators
-                            and 'id' in target_row
-                            and all(match_values.values())
-                            and match_values in existing_without_id):
-                        # find the id of the existing record in the
-                        # target
-                        for i, nt in enumerate(existing):
-                            if match_values == {k: str(v)
-                                                        for k, v in nt.iteritems() if k != 'id'}:
-                                existing_id = existing[i]['id']
-                                break
-                        self.fk_mapping.setdefault(table, {})
-                            # we save the match between source and existing id
-                            # to be able to update the fks in the 2nd pass
-                        self.fk_mapping[table][int(target_row['id'])] = existing_id
-
-                    # fix fk to a moved table with existing data
-                        if source_table in self.is_moved:
-                            source_id = int(source_row['id'])
-                            if source_id in self.fk_mapping[source_table]:
-                                target_row['id'] = existing_id
-                                self.fk_mapping[source_table][source_id] = existing_id
-
-                        self.updatewriters[table].writerow(target_row)
-                    else:
-                        # offset the id of the line, except for m2m (no id)
-                        if 'id' in target_row:
-
-                            target_row['id'] = str(int(target_row['id']) + self.mapping.max_target_id[table])
-                            # handle deferred records
-                            if table in self.mapping.deferred:
-                                upd_row = {k: v for k, v in target_row.iteritems()
-                                           if k == 'id'
-                                           or (k in self.mapping.deferred[table] and v != '')}
-                                if len(upd_row) > 1:
-                                    self.updatewriters[table].writerow(upd_row)
-                                for k in self.mapping.deferred[table]:
-                                    if k in target_row:
-                                        del target_row[k]
-                        # don't write incomplete m2m
-                        if ('id' not in target_row
-                                and len(target_row) == 2
-                                and not all(target_row.values())):
-                            continue
-                        # otherwise write the target csv line
-                        self.writers[table].writerow(target_row)
-
-    def postprocess_one(self, target_filepath):
-        """ Postprocess one target csv file
+                    # otherwise write the target csv line
+                    self.writers[table].writerow(target_row)
+        # execute the writes queued by the sql() calls of the mapping functions
+        self.mapping.flush_sql()
+
+    def postprocess_one(self, target_filepath, chunk=None):
+        """ Postprocess one target csv file, or only the (start, end) byte range of a chunk
         """
         table = basename(target_filepath).rsplit('.', 2)[0]
+        update = 'update' in target_filepath
         with open(target_filepath, 'rb') as target_csv:
-            reader = csv.DictReader(target_csv, delimiter=',')
+            reader = dict_reader(target_csv, chunk)
+            writer = self.writers[table]
             for target_row in reader:
-                write = True
-                postprocessed_row = {}
-                # fix the foreign keys of the line
-                for key, value in target_row.items():
-                    target_record = table + '.' + key
-                    postprocessed_row[key] = value
-                    fk_table = self.fk2update.get(target_record)
-                    # if this is a fk, fix it
-                    if value and fk_table:
-                        # if the target record is an existing record it should be in the fk_mapping
-                        # so we restore the real target id, or offset it if not found
-                        target_table = self.is_moved.get(fk_table, fk_table)
-                        value = int(value)
-                        postprocessed_row[key] = self.fk_mapping.get(fk_table, {}).get(
-                            value, value + self.mapping.max_target_id[target_table])
-                    # if we're postprocessing an update we should restore the id as well, but only if it is an update
-                    if key == 'id' and table in self.fk_mapping and 'update' in target_filepath:
-                        value = int(value)
-                        postprocessed_row[key] = self.fk_mapping[table].get(value, value)
-                    if value and target_record in self.ref_mapping:  # manage __ref__
-                        # first find the target table of the reference
-                        ref_column = self.ref_mapping[target_record]
-                        if ref_column == key: # like ir_property
-                            ref_table, fk_value = value.split(',')
-                            fk_id = int(fk_value)
-                            ref_table = ref_table.replace('.', '_')
-                            try:
-                                new_fk_id = self.fk_mapping.get(ref_table, {}).get(
-                                    fk_id, fk_id + self.mapping.max_target_id[ref_table])
-                            except KeyError:
-                                write = False
-                            postprocessed_row[key] = value.replace(fk_value, str(new_fk_id))
-                        else:
-                            value = int(value)
-                            ref_table = target_row[ref_column].replace('.', '_')
-                            try:
-                                postprocessed_row[key] = self.fk_mapping.get(ref_table, {}).get(
-                                    value, value + self.mapping.max_target_id.get(ref_table, 0))
-                            except KeyError:
-                                print u'Key %s\nTable %s\n' % (key, ref_table)
-                                print target_row
-                                raise
-
-
-                # don't write m2m lines if they exist in the target
-                # FIXME: refactor these 4 lines with those from process_one()?
-                discriminators = self.mapping.discriminators.get(table)
-                existing_without_id = self.existing_m2m_records.get(table, [])
-                existing = self.existing_target_records.get(table)
-                discriminator_values = {d: str(postprocessed_row[d])
-                                        for d in (discriminators or [])}
-                if (write and
-                        ('id' in postprocessed_row or
-                         discriminator_values not in existing_without_id)):
-                    self.writers[table].writerow(postprocessed_row)
+                postprocessed_row = self.postprocess_row(table, target_row, update)
+                if postprocessed_row is not None:
+                    writer.writerow(postprocessed_row)
+
+    def postprocess_row(self, table, target_row, update=False):
+        """ Fix the foreign keys and references of a target row (or an update
+        row) and return it, or None if it must not be written
+        """
+        write = True
+        postprocessed_row = {}
+        # fix the foreign keys of the line
+        for key, value in target_row.items():
+            target_record = table + '.' + key
+            postprocessed_row[key] = value
+            fk_table = self.fk2update.get(target_record)
+            # if this is a fk, fix it. 0 is not a reference, like an empty value
+            if value and fk_table and int(value):
+                # if the target record is an existing record it should be in the fk_mapping
+                # so we restore the real target id, or offset it if not found
+                target_table = self.is_moved.get(fk_table, fk_table)
+                value = int(value)
+                postprocessed_row[key] = self.fk_mapping.get(fk_table, {}).get(
+                    value, self.mapping.target_id(target_table, value))
+            # if we're postprocessing an update we should restore the id as well, but only if it is an update
+            if key == 'id' and table in self.fk_mapping and update:
+                value = int(value)
+                postprocessed_row[key] = self.fk_mapping[table].get(value, value)
+            if value and target_record in self.ref_mapping:  # manage __ref__
+                # first find the target table of the reference
+                ref_column = self.ref_mapping[target_record]
+                if ref_column == key: # like ir_property
+                    ref_table, fk_value = value.split(',')
+                    fk_id = int(fk_value)
+                    ref_table = ref_table.replace('.', '_')
+                    try:
+                        new_fk_id = self.fk_mapping.get(ref_table, {}).get(
+                            fk_id, self.mapping.target_id(ref_table, fk_id))
+                    except KeyError:
+                        write = False
+                    postprocessed_row[key] = value.replace(fk_value, str(new_fk_id))
+                else:
+                    value = int(value)
+                    ref_table = target_row[ref_column].replace('.', '_')
+                    # the ids of the tables which are not migrated are kept
+                    offset_id = value
+                    if ref_table in self.mapping.max_target_id:
+                        offset_id = self.mapping.target_id(ref_table, value)
+                    try:
+                        postprocessed_row[key] = self.fk_mapping.get(ref_table, {}).get(
+                            value, offset_id)
+                    except KeyError:
+                        print u'Key %s\nTable %s\n' % (key, ref_table)
+                        print target_row
+                        raise
+
+
+        # don't write m2m lines if they exist in the target
+        # FIXME: refactor these 4 lines with those from process_one()?
+        discriminators = self.mapping.discriminators.get(table)
+        existing = self.existing_target_records.get(table, {})
+        discriminator_values = tuple(str(postprocessed_row[d])
+                                     for d in (discriminators or []))
+        if (write and
+                ('id' in postprocessed_row or
+                 discriminator_values not in existing)):
+            return postprocessed_row
 
     @staticmethod
-    def update_all(filepaths, connection, suffix=""):
+    def update_all(filepaths, connection, suffix="", primary_keys=None):
         """ Apply updates in the target db with update file
+        primary_keys is given to setup_temp_table
+        Empty values of the update files keep the existing values, and only
+        the rows with changed values are updated
         """
 
         to_update = []
-        upd_record = namedtuple('upd_record', 'path, target, suffix, cols, pkey')
         for filepath in filepaths:
             target_table = basename(filepath).rsplit('.', 2)[0]
-            temp_table = target_table + suffix
             with open(filepath, 'rb') as update_csv, connection.cursor() as c:
                 reader = csv.DictReader(update_csv, delimiter=',')
                 for x in reader: # lame way to check if it has lines - Note: try while reader:
                     update_csv.seek(0)
-                    pkey = setup_temp_table(c, target_table, suffix=suffix)
-                    if not pkey:
-                        LOG.error(u'Can\'t update data without primary key')
-                    else:
-                        columns = ','.join(["{0}=COALESCE({2}.{0}, {1}.{0})".format(col, target_table, temp_table)
-                                         for col in csv.reader(update_csv).next() if col != pkey])
-                        to_update.append(upd_record(filepath, target_table, suffix, columns, pkey))
+                    header = csv.reader(update_csv).next()
+                    record = setup_update(c, filepath, target_table, header, suffix,
+                                          primary_keys)
+                    if record:
+                        to_update.append(record)
                     break
         if to_update:
             upsert(to_update, connection)
         else:
             LOG.info(u'Nothing to update')
 
+    def update_deferred(self, filepaths, connection, suffix="", primary_keys=None,
+                        processes=1, commit=True):
+        """ Apply the deferred columns of the update files in the target db.
+        The rows which only have values in the primary key and the deferred
+        columns are moved to a .deferred2.csv file with only these columns,
+        applied through a narrow temp table. With commit, each table is updated
+        and committed by a worker with its own connection, otherwise the tables
+        are updated in the transaction of the connection, which may be rolled
+        back. The .deferred2.csv files left by a previous attempt are applied
+        again, without splitting again
+        """
+        deferred_filepaths = []
+        for filepath in filepaths:
+            table = basename(filepath).rsplit('.', 2)[0]
+            pkey = (primary_keys or {}).get(table, 'id')
+            columns = self.mapping.deferred.get(table)
+            deferred_filepath = filepath.replace('.update2.csv', '.deferred2.csv')
+            if exists(deferred_filepath) or (
+                    columns and split_deferred(filepath, columns, pkey)):
+                deferred_filepaths.append(deferred_filepath)
+        if not deferred_filepaths:
+            return
+        deferred_filepaths.sort(key=getsize, reverse=True)
+        if not commit:
+            for filepath in deferred_filepaths:
+                with connection.cursor() as c:
+                    apply_deferred(c, filepath, suffix, primary_keys)
+            return
+        pool = Pool(processes)
+        try:
+            pool.map(partial(_update_deferred, dsn=connection.dsn, suffix=suffix,
+                             primary_keys=primary_keys),
+                     deferred_filepaths, 1)
+        finally:
+            pool.close()
+            pool.join()
+
     def drop_stored_columns(self, connection):
         for table, columns in self.mapping.stored_fields.items():
             # potentially unsafe
             query = ','.join(['DROP COLUMN %s CASCADE' % f for f in columns])
             with connection.cursor() as c:
                 c.execute('ALTER TABLE %s %s' % (table, query))
+
+
+
+
+class SinglePassWriter(object):
+    """ Writer of target or update rows during single pass processing.
+    Rows whose foreign keys can already be fixed are postprocessed and
+    written in the final file, the others are written in a spill file
+    """
+    def __init__(self, processor, table, writer, spill_writer, update=False):
+        self.processor = processor
+        self.table = table
+        self.writer = writer
+        self.spill_writer = spill_writer
+        self.update = update
+        self.spilled = 0
+        self.fieldnames = writer.fieldnames
+        self.fieldset = frozenset(self.fieldnames)
+        fk2update = processor.fk2update
+        self.fk_columns = [(c, fk2update[table + '.' + c]) for c in self.fieldnames
+                           if table + '.' + c in fk2update]
+        self.ref_columns = []
+        self.ref_mapping_size = None
+
+    def writerow(self, row):
+        # refuse unknown columns like csv.DictWriter
+        if not self.fieldset.issuperset(row):
+            raise ValueError(u'dict contains fields not in fieldnames: %s' % ', '.join(
+                repr(k) for k in row if k not in self.fieldset))
+        # the row should be the same as if it was read back from a csv file
+        row = {k: '' if row.get(k) is None
+               else repr(row[k]) if isinstance(row[k], float)
+               else row[k] if isinstance(row[k], basestring)
+               else str(row[k])
+               for k in self.fieldnames}
+        if self.is_pending(row):
+            self.spilled += 1
+            self.spill_writer.writerow(row)
+            return
+        row = self.processor.postprocess_row(self.table, row, self.update)
+        if row is not None:
+            self.writer.writerow(row)
+
+    def is_pending(self, row):
+        """ Return True if the row points to a table whose fk mapping may change
+        """
+        pending = self.processor.pending
+        if not pending:
+            return False
+        # the id of an update row is restored from the mapping of the table
+        if self.update and self.table in pending:
+            return True
+        for column, fk_table in self.fk_columns:
+            if row[column] and fk_table in pending:
+                return True
+        # references are added to the ref_mapping when compiling a source table
+        ref_mapping = self.processor.ref_mapping
+        if len(ref_mapping) != self.ref_mapping_size:
+            self.ref_mapping_size = len(ref_mapping)
+            self.ref_columns = [(c, ref_mapping[self.table + '.' + c]) for c in self.fieldnames
+                                if self.table + '.' + c in ref_mapping]
+        for column, ref_column in self.ref_columns:
+            value = row[column]
+            if not value:
+                continue
+            ref_table = value.split(',')[0] if ref_column == column else row.get(ref_column, '')
+            if ref_table.replace('.', '_') in pending:
+                return True
+        return False
+
+def split_csv(filepath, chunk_size, block_size=1048576):
+    """ Split the rows of a csv file in byte ranges of about chunk_size bytes.
+    Return a list of (start, end, lines) where lines is the number of
+    newlines in the range. Newlines inside quoted values are not row
+    boundaries, so quotes are counted from the start of the file
+    """
+    chunks = []
+    with open(filepath, 'rb') as f:
+        start = pos = len(f.readline())  # skip the header
+        quoted = 0
+        newlines = start_newlines = 0
+        for block in iter(lambda: f.read(block_size), ''):
+            i = 0
+            while True:
+                offset = start + chunk_size - pos  # where the chunk may end
+                if offset > i:
+                    if offset >= len(block):
+                        quoted ^= block.count('"', i) & 1
+                        break
+                    quoted ^= block.count('"', i, offset) & 1
+                    i = offset
+                j = block.find('\n', i)
+                if j == -1:
+                    quoted ^= block.count('"', i) & 1
+                    break
+                quoted ^= block.count('"', i, j) & 1
+                i = j + 1
+                if not quoted:
+                    end_newlines = newlines + block.count('\n', 0, i)
+                    chunks.append((start, pos + i, end_newlines - start_newlines))
+                    start, start_newlines = pos + i, end_newlines
+            newlines += block.count('\n')
+            pos += len(block)
+    if pos > start:
+        chunks.append((start, pos, newlines - start_newlines))
+    return chunks
+
+
+def dict_reader(f, chunk=None):
+    """ Return a csv.DictReader on an open csv file,
+    or only on the (start, end) byte range of a chunk of it
+    """
+    if chunk is None:
+        return csv.DictReader(f, delimiter=',')
+    fieldnames = csv.reader([f.readline()]).next()
+    start, end = chunk
+    f.seek(start)
+
+    def lines(pos):
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+    return csv.DictReader(lines(start), fieldnames, delimiter=',')
+
+
+def transform_rows(transform, reader):
+    """ Yield the source rows of a reader with their target rows.
+    The batch functions of the transform are called once per block of rows
+    """
+    if not transform.batch:
+        for source_row in reader:
+            yield source_row, transform(source_row)
+        return
+    for block in iter(lambda: list(islice(reader, BATCH_SIZE)), []):
+        for source_row, values in izip(block, transform.batch(block)):
+            yield source_row, transform(source_row, values)
+
+
+class BatchColumns(object):
+    """ The columns of a block of source rows, given to the batch functions:
+    columns['name'] is the list of the values of the name column
+    """
+    def __init__(self, source_rows):
+        self.source_rows = source_rows
+        self.columns = {}
+
+    def __getitem__(self, column):
+        if column not in self.columns:
+            self.columns[column] = [row.get(column) for row in self.source_rows]
+        return self.columns[column]
+
+
+UpdateRecord = namedtuple('upd_record', 'path, target, suffix, cols, pkey, changed')
+
+
+def setup_update(cursor, filepath, target_table, header, suffix="", primary_keys=None):
+    """ Create the temp table of an update file with the columns of its header,
+    and return the record to give to upsert, or None
+    """
+    temp_table = target_table + suffix
+    pkey = setup_temp_table(cursor, target_table, suffix=suffix,
+                            primary_keys=primary_keys, columns=header)
+    updated = [col for col in header if col != pkey]
+    if not pkey:
+        LOG.error(u'Can\'t update data without primary key')
+        return None
+    if not updated:
+        return None
+    values = ["COALESCE({2}.{0}, {1}.{0})".format(col, target_table, temp_table)
+              for col in updated]
+    columns = ','.join(["{0}={1}".format(col, value)
+                        for col, value in zip(updated, values)])
+    # compare the rows to skip the unchanged ones, as text
+    # because some types (json, point...) have no equality
+    changed = "({0}) IS DISTINCT FROM ({1})".format(
+        ','.join(["{1}.{0}::text".format(col, target_table) for col in updated]),
+        ','.join([value + '::text' for value in values]))
+    return UpdateRecord(filepath, target_table, suffix, columns, pkey, changed)
+
+
+def split_deferred(filepath, columns, pkey):
+    """ Move the rows of an update file which only have values in the primary
+    key and the given columns to a .deferred2.csv file with only these columns.
+    Return the number of moved rows
+    """
+    deferred_filepath = filepath.replace('.update2.csv', '.deferred2.csv')
+    with open(filepath, 'rb') as f:
+        header = csv.reader([f.readline()]).next()
+        if pkey not in header:
+            return 0
+        narrow = [pkey] + [col for col in header if col in columns]
+        if len(narrow) == 1:
+            return 0
+        indexes = [header.index(col) for col in narrow]
+        others = [i for i, col in enumerate(header) if col not in narrow]
+        moved = 0
+        with open(filepath + '.rest', 'wb') as rest, open(deferred_filepath, 'wb') as deferred:
+            rest_writer, deferred_writer = csv.writer(rest), csv.writer(deferred)
+            rest_writer.writerow(header)
+            deferred_writer.writerow(narrow)
+            for row in csv.reader(f):
+                if any(row[i] for i in others):
+                    rest_writer.writerow(row)
+                else:
+                    deferred_writer.writerow([row[i] for i in indexes])
+                    moved += 1
+    os.rename(filepath + '.rest', filepath)
+    if not moved:
+        os.remove(deferred_filepath)
+    return moved
+
+
+def append_parts(f, part_filenames):
+    """ Append the content of part files to an open file, and remove them
+    """
+    for part_filename in part_filenames:
+        with open(part_filename, 'rb') as part:
+            shutil.copyfileobj(part, f)
+        os.remove(part_filename)
+
+def _init_worker():
+    """ Give each worker process its own database connections
+    """
+    mapping = _PROCESSOR.mapping
+    # keep a reference to the inherited connections: if they were garbage
+    # collected here, the sessions of the parent process would be closed
+    _init_worker.inherited = (mapping.source_connection, mapping.target_connection)
+    for attr in ('source_connection', 'target_connection'):
+        connection = getattr(mapping, attr)
+        if connection is not None:
+            setattr(mapping, attr, get_db_connection(dsn=connection.dsn))
+
+
+def _process_group(args):
+    """ Process a group of source tables in a worker process
+    and return the state to merge in the parent processor
+    """
+    source_dir, source_tables, target_dir, target_tables = args
+    processor = _PROCESSOR
+    lines = processor.lines
+    new_id = dict(processor.mapping.new_id)
+    processor.mapping.fk_lookup_stats = {}
+    processor.process_tables(source_dir, source_tables, target_dir, target_tables)
+    owned = set(source_tables) | set(target_tables)
+    return (processor.lines - lines,
+            {t: ids for t, ids in processor.fk_mapping.iteritems() if t in owned},
+            {t: moved for t, moved in processor.is_moved.iteritems() if t in owned},
+            processor.ref_mapping,
+            {t: i for t, i in processor.mapping.new_id.iteritems() if i != new_id.get(t)},
+            processor.mapping.fk_lookup_stats)
+
+
+def _process_chunk(args):
+    """ Process a chunk of a source table in a worker process and return
+    the state to merge in the parent processor, or None if the chunk
+    allocated new ids out of the ranges reserved for it
+    """
+    source_filepath, index, chunk, target_dir, target_tables, new_id, reserved = args
+    processor = _PROCESSOR
+    source_table = basename(source_filepath).rsplit('.', 1)[0]
+    owned = set([source_table]) | set(target_tables)
+    # only return the ids mapped by this chunk
+    for table in owned:
+        processor.fk_mapping.pop(table, None)
+    processor.mapping.new_id.update(new_id)
+    processor.mapping.fk_lookup_stats = {}
+    lines = processor.lines
+    files = processor.open_writers(target_dir, target_tables, part=index)
+    try:
+        processor.process_one(source_filepath, chunk=chunk)
+    finally:
+        for f in files:
+            f.close()
+    advanced = {t: i for t, i in processor.mapping.new_id.iteritems() if i != new_id.get(t)}
+    for table, value in advanced.iteritems():
+        if table not in target_tables or value - new_id[table] > reserved:
+            LOG.warn(u'Chunk %s of %s allocated more new ids of %s than reserved',
+                     index, source_table, table)
+            return None
+    return (processor.lines - lines,
+            {t: ids for t, ids in processor.fk_mapping.iteritems() if t in owned},
+            {t: moved for t, moved in processor.is_moved.iteritems() if t in owned},
+            processor.ref_mapping,
+            advanced,
+            processor.mapping.fk_lookup_stats)
+
+
+def apply_deferred(cursor, filepath, suffix="", primary_keys=None):
+    """ Apply a .deferred2.csv file through a narrow temp table
+    """
+    from .importing import copy_from_file
+    table = basename(filepath).rsplit('.', 2)[0]
+    with open(filepath, 'rb') as f:
+        header = csv.reader([f.readline()]).next()
+    record = setup_update(cursor, filepath, table, header, suffix, primary_keys)
+    copy_from_file(cursor, table + suffix, filepath)
+    if record is not None:
+        update_from_temp_table(cursor, record)
+    drop_temp_table(cursor, table, suffix)
+    LOG.info(u'Updated the deferred columns of %s', table)
+
+
+def _update_deferred(filepath, dsn=None, suffix="", primary_keys=None):
+    """ Apply a .deferred2.csv file in a worker process, with its own connection
+    """
+    with get_db_connection(dsn=dsn) as connection:
+        with connection.cursor() as c:
+            apply_deferred(c, filepath, suffix, primary_keys)
+
+
+def _postprocess_file(args):
+    """ Postprocess a target file, or a chunk of it, in a worker process.
+    The rows of a whole file are appended to the output file, those of a
+    chunk are written in a part file
+    """
+    target_filepath, chunk, output = args
+    processor = _PROCESSOR
+    table = basename(target_filepath).rsplit('.', 2)[0]
+    with open(output, 'ab' if chunk is None else 'wb') as f:
+        processor.writers = {
+            table: csv.DictWriter(f, processor.target_columns[table], delimiter=',')}
+        processor.postprocess_one(target_filepath, chunk)
@@ -2,6 +2,7 @@ import sys
 from os.path import basename, exists
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
@@ -18,6 +19,41 @@ def get_db_connection(dsn=None):
     return psycopg2.connect(dsn=dsn)
 
 
+def export_snapshot(connection):
+    """ Start a repeatable read transaction on the connection and return the
+    id of its snapshot, which other transactions can use while it is open
+    (see set_snapshot)
+    """
+    connection.set_isolation_level(ISOLATION_LEVEL_REPEATABLE_READ)
+    with connection.cursor() as c:
+        c.execute("SELECT pg_export_snapshot()")
+        return c.fetchone()[0]
+
+
+def set_snapshot(cursor, snapshot):
+    """ Make the new transaction of the cursor see the same data as the
+    transaction which exported the snapshot
+    """
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+
+
+def get_table_sizes(connection, tables):
+    """ Return the number of pages of the tables: {table: relpages}
+    """
+    if not tables:
+        return {}
+    with connection.cursor() as c:
+        c.execute("""
+SELECT relname, relpages
+FROM pg_class, pg_namespace
+WHERE
+  pg_class.relnamespace = pg_namespace.oid AND
+  nspname = 'public' AND
+  relname IN %s""", (tuple(tables),))
+        return dict(c.fetchall())
+
+
 def get_table_columns(dsn, source_table):
     db_connection = get_db_connection(dsn)
     with db_connection.cursor() as c:
@@ -27,6 +63,29 @@ def get_table_columns(dsn, source_table):
     return colnames
 
 
+def get_column_types(connection, tables):
+    """ Return the type oids of the columns of the tables:
+    {table: {column: oid}}
+    """
+    if not tables:
+        return {}
+    with connection.cursor() as c:
+        c.execute("""
+SELECT relname, attname, atttypid
+FROM pg_attribute, pg_class, pg_namespace
+WHERE
+  pg_attribute.attrelid = pg_class.oid AND
+  pg_class.relnamespace = pg_namespace.oid AND
+  nspname = 'public' AND
+  relname IN %s AND
+  attnum > 0 AND
+  NOT attisdropped""", (tuple(tables),))
+        types = {}
+        for table, column, oid in c.fetchall():
+            types.setdefault(table, {})[column] = oid
+    return types
+
+
 def kill_db_connections(cursor, datname):
     cursor.execute('SELECT pg_terminate_backend(pg_stat_activity.pid) '
                    'FROM pg_stat_activity '
@@ -98,12 +157,43 @@ SELECT
     return add_command
 
 
-def setup_temp_table(cursor, target_table, suffix=""):
+def get_primary_keys(connection, tables):
+    """ Return the primary key column of the tables: {table: column}
+    """
+    if not tables:
+        return {}
+    with connection.cursor() as c:
+        c.execute('''
+SELECT
+  pg_class.relname,
+  pg_attribute.attname
+FROM pg_index, pg_class, pg_attribute, pg_namespace
+WHERE
+  pg_class.relname IN %s AND
+  indrelid = pg_class.oid AND
+  nspname = 'public' AND
+  pg_class.relnamespace = pg_namespace.oid AND
+  pg_attribute.attrelid = pg_class.oid AND
+  pg_attribute.attnum = any(pg_index.indkey)
+ AND indisprimary;''', (tuple(tables),))
+        return dict(c.fetchall())
+
+
+def setup_temp_table(cursor, target_table, suffix="", primary_keys=None, columns=None):
+    """ Create the temp table of a target table and return its primary key.
+    The primary key is looked up in primary_keys if given (see get_primary_keys)
+    With columns, the temp table only has these columns of the target table
+    """
     if validate_identifiers(target_table):
-        create_command = "CREATE TEMP TABLE {0}{1} AS SELECT * FROM {0} LIMIT 0".format(target_table, suffix)
+        select = columns and ','.join('"%s"' % col for col in columns) or '*'
+        create_command = "CREATE TEMP TABLE {0}{1} AS SELECT {2} FROM {0} LIMIT 0".format(
+            target_table, suffix, select)
         cursor.execute(create_command)
-        # We need to find the primary key using accepted postgres method
-        cursor.execute('''
+        if primary_keys is not None:
+            pkey = primary_keys.get(target_table)
+        else:
+            # We need to find the primary key using accepted postgres method
+            cursor.execute('''
 SELECT
   pg_attribute.attname,
   format_type(pg_attribute.atttypid, pg_attribute.atttypmod)
@@ -116,18 +206,34 @@ WHERE
   pg_attribute.attrelid = pg_class.oid AND
   pg_attribute.attnum = any(pg_index.indkey)
  AND indisprimary;''', (target_table,))
-        pkey = cursor.fetchone()
-        if pkey:
-            pkey = pkey[0]
-            idx_command = "CREATE INDEX {0}_id_idx ON {0}({1});".format(target_table, pkey)
-            cursor.execute(idx_command)
-        else:
-            pkey = None
-        return pkey
+            pkey = cursor.fetchone()
+            pkey = pkey and pkey[0]
+        return pkey or None
     else:
         return None
 
 
+def drop_indexes(cursor, tables):
+    """ Drop the indexes of the tables which neither back a constraint nor are
+    unique, and return their definitions to recreate them after an import
+    """
+    if not tables:
+        return []
+    cursor.execute("""
+SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid)
+FROM pg_index, pg_class
+WHERE
+  pg_index.indrelid = pg_class.oid AND
+  pg_class.relname IN %s AND
+  NOT indisunique AND
+  NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)""",
+                   (tuple(tables),))
+    indexes = cursor.fetchall()
+    for name, _ in indexes:
+        cursor.execute("DROP INDEX %s" % name)
+    return [definition for _, definition in indexes]
+
+
 def drop_temp_table(cursor, target_table, suffix=""):
     if validate_identifiers(target_table):
         drop_command = "DROP TABLE {0}{1};".format(target_table, suffix)
@@ -159,21 +265,35 @@ def make_savepoint(c, name='savepoint'):
 def upsert(update_list, connection):
     """
 
-    :param update_list: namedtuple consisting of path, target, suffix, cols, pkey
+    :param update_list: namedtuple consisting of path, target, suffix, cols, pkey, changed
     :param connection:
+    The rows are staged in the temp tables, which are analyzed so that they
+    are joined by primary key without index, and the target rows are updated
+    only if their values change
     """
     assert all([validate_identifiers(u.target) for u in update_list])
     from .importing import update_from_csv
 
     update_from_csv([u.path for u in update_list], connection, suffix=update_list[0].suffix)
     with connection.cursor() as c:
-        update_cmd = ";\n".join(["UPDATE {0.target} SET {0.cols} "
-                                 "FROM {0.target}{0.suffix} "
-                                 "WHERE {0.target}.{0.pkey}={0.target}{0.suffix}.{0.pkey} ".format(x) for x in update_list])
-        try:
-            c.execute(update_cmd)
-        except psycopg2.IntegrityError as e:
-            LOG.error(update_cmd)
-            raise e
+        for x in update_list:
+            update_from_temp_table(c, x)
         make_savepoint(c)
     return
+
+
+def update_from_temp_table(cursor, x):
+    """ Update the target rows from the filled temp table of an update record
+    (see upsert)
+    """
+    cursor.execute("ANALYZE {0.target}{0.suffix}".format(x))
+    update_cmd = ("UPDATE {0.target} SET {0.cols} "
+                  "FROM {0.target}{0.suffix} "
+                  "WHERE {0.target}.{0.pkey}={0.target}{0.suffix}.{0.pkey} "
+                  "AND {0.changed}".format(x))
+    try:
+        cursor.execute(update_cmd)
+    except psycopg2.IntegrityError as e:
+        LOG.error(update_cmd)
+        raise e
+    LOG.info(u'Updated %s rows of %s', cursor.rowcount, x.target)
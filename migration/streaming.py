@@ -0,0 +1,164 @@
+import csv
+import os
+import threading
+from os.path import basename, join
+
+from . import pgbinary
+from .processing import SinglePassWriter
+from .sql_commands import get_db_connection, set_snapshot
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+LOG = logging.getLogger(basename(__file__))
+
+
+class CopyThread(threading.Thread):
+    """ Run a COPY statement in a thread, with its own connection,
+    from or to one end of a pipe. The other end is the ``pipe`` attribute:
+    we read the rows exported by a COPY TO or write those imported by a COPY FROM
+    """
+    def __init__(self, dsn, copy, export=False, snapshot=None):
+        super(CopyThread, self).__init__()
+        self.daemon = True
+        self.copy = copy
+        self.snapshot = snapshot
+        self.error = None
+        self.connection = get_db_connection(dsn=dsn)
+        read_fd, write_fd = os.pipe()
+        if export:
+            self.file, self.pipe = os.fdopen(write_fd, 'wb'), os.fdopen(read_fd, 'rb')
+        else:
+            self.file, self.pipe = os.fdopen(read_fd, 'rb'), os.fdopen(write_fd, 'wb')
+
+    def run(self):
+        try:
+            with self.connection.cursor() as c:
+                if self.snapshot:
+                    set_snapshot(c, self.snapshot)
+                c.copy_expert(self.copy, self.file)
+        except Exception, e:
+            self.error = e
+        finally:
+            # the other end gets EOF (or a broken pipe)
+            self.file.close()
+
+    def finish(self):
+        """ Close our end of the pipe and wait for the COPY to end
+        """
+        try:
+            self.pipe.close()
+        except IOError, e:  # unflushed rows on a broken pipe
+            self.error = self.error or e
+        self.join()
+        return self.error
+
+
+def stream_tables(processor, source_dir, source_tables, source_dsn, target_dsn,
+                  binary_tables=None, snapshot=None, streamed=(), callback=None):
+    """ Export, process and import source tables without csv files.
+    The rows exported by a COPY TO on the source are processed as they come,
+    postprocessed right away and sent to a COPY FROM on each target table.
+    The fk mappings must be complete, so it should be done after processing
+    the other tables, and only for the tables which don't change these
+    mappings (see CSVProcessor.get_streamable_tables). source_dir only
+    contains the headers of the source tables.
+    The tables of binary_tables {source table: target table} are streamed
+    with binary COPY data (see CSVProcessor.get_binary_tables)
+    The source tables are exported from the snapshot, if given
+    (see sql_commands.export_snapshot)
+    The tables already streamed are skipped, and callback is called with
+    each source table once its target tables are committed
+    """
+    binary_tables = binary_tables or {}
+    for source_table in source_tables:
+        if source_table in streamed:
+            continue
+        source_filepath = join(source_dir, source_table + '.csv')
+        if source_table in binary_tables:
+            stream_binary_table(processor, source_filepath, binary_tables[source_table],
+                                source_dsn, target_dsn, snapshot)
+        else:
+            stream_table(processor, source_filepath, source_dsn, target_dsn, snapshot)
+        if callback is not None:
+            callback(source_table)
+
+
+def stream_table(processor, source_filepath, source_dsn, target_dsn, snapshot=None):
+    """ Stream one source table to its target tables.
+    The target tables are committed only if every COPY succeeded
+    """
+    source_table = basename(source_filepath).rsplit('.', 1)[0]
+    target_tables = processor.get_source_targets(source_filepath)
+    export = CopyThread(
+        source_dsn, """COPY "%s" TO STDOUT WITH CSV HEADER NULL ''""" % source_table,
+        export=True, snapshot=snapshot)
+    imports = {}
+    for table in target_tables:
+        columns = ','.join(['"%s"' % col for col in processor.target_columns[table]])
+        imports[table] = CopyThread(
+            target_dsn, "COPY %s (%s) FROM STDOUT WITH CSV HEADER NULL ''" % (table, columns))
+    threads = [export] + imports.values()
+    for thread in threads:
+        thread.start()
+    errors = []
+    try:
+        processor.writers, processor.updatewriters = {}, {}
+        for table, thread in imports.items():
+            writer = csv.DictWriter(thread.pipe, processor.target_columns[table], delimiter=',')
+            writer.writeheader()
+            processor.writers[table] = SinglePassWriter(processor, table, writer, None)
+        processor.process_rows(source_table, csv.DictReader(export.pipe, delimiter=','))
+    except Exception, e:
+        errors.append(e)
+    finish_threads(threads, errors, source_table)
+    LOG.info(u"SUCCESS streaming %s to %s", source_table, ', '.join(sorted(target_tables)))
+
+
+def stream_binary_table(processor, source_filepath, target_table, source_dsn, target_dsn,
+                        snapshot=None):
+    """ Stream one source table to its target table with binary COPY data.
+    Only the id and foreign keys are decoded (see CSVProcessor.compile_binary_transform)
+    """
+    source_table = basename(source_filepath).rsplit('.', 1)[0]
+    with open(source_filepath, 'rb') as f:
+        header = csv.reader([f.readline()]).next()
+    transform = processor.compile_binary_transform(source_table, target_table, header)
+    export = CopyThread(
+        source_dsn, 'COPY "%s" TO STDOUT WITH BINARY' % source_table, export=True,
+        snapshot=snapshot)
+    columns = ','.join(['"%s"' % col for col in processor.target_columns[target_table]])
+    imports = CopyThread(
+        target_dsn, "COPY %s (%s) FROM STDOUT WITH BINARY" % (target_table, columns))
+    threads = [export, imports]
+    for thread in threads:
+        thread.start()
+    errors = []
+    try:
+        writer = pgbinary.BinaryWriter(imports.pipe)
+        for source_row in pgbinary.read_rows(export.pipe):
+            processor.lines += 1
+            target_row = transform(source_row)
+            if target_row is not None:
+                writer.writerow(target_row)
+        writer.close()
+    except Exception, e:
+        errors.append(e)
+    finish_threads(threads, errors, source_table)
+    LOG.info(u"SUCCESS streaming %s to %s in binary", source_table, target_table)
+
+
+def finish_threads(threads, errors, source_table):
+    """ Wait for the COPY threads, then commit them all,
+    or roll them all back and raise the first error
+    """
+    errors += [e for e in [thread.finish() for thread in threads] if e is not None]
+    for thread in threads:
+        if errors:
+            thread.connection.rollback()
+        else:
+            thread.connection.commit()
+        thread.connection.close()
+    if errors:
+        for e in errors:
+            LOG.error(u'Streaming Error for %s: %s', source_table, e)
+        raise errors[0]
@@ -0,0 +1,69 @@
+import shutil
+import tempfile
+import unittest
+from os.path import join
+from migration.checkpoint import Manifest
+
+
+class TestManifest(unittest.TestCase):
+
+    """ Tests """
+
+    def setUp(self):
+        super(TestManifest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestManifest, self).tearDown()
+
+    def write(self, filename, data):
+        with open(join(self.directory, filename), 'wb') as f:
+            f.write(data)
+        return join(self.directory, filename)
+
+    def test_resume(self):
+        """ The completed stages and the data are read again from the directory
+        """
+        manifest = Manifest(self.directory)
+        manifest.complete('export', [self.write('a.csv', 'id\n1\n')])
+        manifest.set('lines', 1)
+        manifest = Manifest(self.directory)
+        self.assertEqual(manifest.check(), ['export'])
+        self.assertTrue(manifest.is_done('export'))
+        self.assertFalse(manifest.is_done('process'))
+        self.assertEqual(manifest.get('lines'), 1)
+
+    def test_modified_files(self):
+        """ The last stages whose files were modified are run again
+        """
+        manifest = Manifest(self.directory)
+        manifest.complete('export', [self.write('a.csv', 'id\n1\n')])
+        manifest.complete('process', [self.write('a.target2.csv', 'id\n2\n')])
+        self.write('a.target2.csv', 'id\n3\n')
+        manifest = Manifest(self.directory)
+        self.assertEqual(manifest.check(), ['export'])
+        self.assertFalse(manifest.is_done('process'))
+        self.assertEqual(Manifest(self.directory).stages, ['export'])
+
+    def test_previous_files(self):
+        """ Only the files of the last stage are needed to resume
+        """
+        manifest = Manifest(self.directory)
+        manifest.complete('export', [self.write('a.csv', 'id\n1\n')])
+        manifest.complete('process', [self.write('a.target2.csv', 'id\n2\n')])
+        self.write('a.csv', '')
+        self.assertEqual(Manifest(self.directory).check(), ['export', 'process'])
+
+    def test_reset(self):
+        """ A stage is run again with the following ones
+        """
+        manifest = Manifest(self.directory)
+        manifest.complete('export', [self.write('a.csv', 'id\n1\n')])
+        manifest.complete('process', [self.write('a.target2.csv', 'id\n2\n')])
+        manifest.set('imported', ['a'])
+        manifest.reset('export')
+        manifest = Manifest(self.directory)
+        self.assertEqual(manifest.check(), [])
+        self.assertEqual(manifest.files, {})
+        self.assertEqual(manifest.get('imported'), ['a'])
@@ -49,3 +49,96 @@ class TestDepending(unittest.TestCase):
         self.assertTrue(all([x in groups_excl for x in ['res_users', 'res_groups',
                                         'res_groups_implied_rel',
                                         'res_groups_users_rel']]))
+
+    def graph(self, references, with_id):
+        """ Return a DependencyGraph of the given references, without database
+        """
+        graph = depending.DependencyGraph.__new__(depending.DependencyGraph)
+        graph.references, graph.referenced_by = {}, {}
+        for table, related_tables in references.items():
+            for related_table in related_tables:
+                graph.references.setdefault(table, set()).add(related_table)
+                graph.referenced_by.setdefault(related_table, set()).add(table)
+        graph.with_id = set(with_id)
+        return graph
+
+    def test_get_sql_dependencies(self):
+        """ The tables are ordered by dependencies, despite loops and long chains
+        """
+        graph = self.graph({'a': ['b'], 'b': ['c'], 'c': ['a'], 'a_b_rel': ['a', 'b']},
+                           ['a', 'b', 'c'])
+        res, related = depending.get_sql_dependencies(None, ['a'], ['a'], ['a'], None,
+                                                      graph=graph)
+        self.assertEqual(res, ['c', 'b', 'a'])
+        self.assertEqual(related, set(['a_b_rel']))
+        tables = ['t%s' % i for i in range(2000)]
+        graph = self.graph({t: [tables[i + 1]] for i, t in enumerate(tables[:-1])}, tables)
+        res, _ = depending.get_sql_dependencies(None, tables[:1], tables[:1], tables[:1],
+                                                None, graph=graph)
+        self.assertEqual(res, tables[::-1])
+
+    def test_get_import_levels(self):
+        """ The tables only reference the tables of the previous levels,
+        and the cycles are broken by deferring foreign keys
+        """
+        foreign_keys = {
+            'res_partner.parent_id': 'res_partner',
+            'res_partner.create_uid': 'res_users',
+            'res_partner.company_id': 'res_company',
+            'res_users.partner_id': 'res_partner',
+            'res_users.company_id': 'res_company',
+            'res_company.partner_id': 'res_partner',
+            'res_country.create_uid': 'res_users',
+            'ir_model.create_uid': 'res_users',
+        }
+        levels, deferred = depending.get_import_levels(
+            ['res_partner', 'res_users', 'res_company', 'res_country'],
+            foreign_keys, {'res_partner': set(['company_id'])})
+        self.assertEqual(deferred, {'res_partner': set(['create_uid'])})
+        self.assertEqual(levels, [['res_partner'], ['res_company'],
+                                  ['res_users'], ['res_country']])
+
+    def test_get_import_levels_not_null(self):
+        """ The NOT NULL foreign keys of a cycle are not deferred, the columns
+        deferred by the mapping are deferred first, and a cycle of NOT NULL
+        foreign keys is refused
+        """
+        foreign_keys = {
+            'res_partner.create_uid': 'res_users',
+            'res_partner.company_id': 'res_company',
+            'res_users.partner_id': 'res_partner',
+            'res_users.company_id': 'res_company',
+            'res_company.partner_id': 'res_partner',
+        }
+        tables = ['res_partner', 'res_users', 'res_company']
+        levels, deferred = depending.get_import_levels(
+            tables, foreign_keys, not_null=set(['res_partner.create_uid',
+                                                'res_users.company_id']))
+        self.assertEqual(deferred, {'res_company': set(['partner_id']),
+                                    'res_users': set(['partner_id'])})
+        self.assertEqual(levels, [['res_company'], ['res_users'], ['res_partner']])
+        self.assertRaises(ValueError, depending.get_import_levels, tables, foreign_keys,
+                          not_null=set(['res_partner.create_uid', 'res_users.partner_id']))
+        foreign_keys = {
+            'res_partner.create_uid': 'res_users',
+            'res_partner.write_uid': 'res_users',
+            'res_users.partner_id': 'res_partner',
+        }
+        levels, deferred = depending.get_import_levels(
+            tables, foreign_keys, {'res_users': set(['create_uid', 'write_uid'])})
+        self.assertEqual(deferred, {'res_partner': set(['create_uid', 'write_uid'])})
+        levels, deferred = depending.get_import_levels(tables, foreign_keys)
+        self.assertEqual(deferred, {'res_users': set(['partner_id'])})
+
+    def test_get_self_references(self):
+        """ Deferred foreign keys to the table itself are ignored
+        """
+        foreign_keys = {
+            'res_partner.parent_id': 'res_partner',
+            'res_partner.create_uid': 'res_users',
+            'res_users.create_uid': 'res_users',
+        }
+        self.assertEqual(depending.get_self_references(foreign_keys),
+                         set(['res_partner', 'res_users']))
+        self.assertEqual(depending.get_self_references(
+            foreign_keys, {'res_users': set(['create_uid'])}), set(['res_partner']))
@@ -0,0 +1,58 @@
+import unittest
+import shutil
+from os.path import join, exists
+from tempfile import mkdtemp
+from migration import exporting, pgbinary
+
+
+class TestExporting(unittest.TestCase):
+
+    """ Tests """
+
+    def setUp(self):
+        super(TestExporting, self).setUp()
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestExporting, self).tearDown()
+
+    def test_split_ids(self):
+        """ The ids are split in open ranges of equal size, no more than the ids
+        """
+        self.assertEqual(exporting.split_ids(1, 100, 4),
+                         ['id < 26', 'id >= 26 AND id < 51', 'id >= 51 AND id < 76',
+                          'id >= 76 OR id IS NULL'])
+        self.assertEqual(exporting.split_ids(5, 7, 10),
+                         ['id < 6', 'id >= 6 AND id < 7', 'id >= 7 OR id IS NULL'])
+        # an empty table, or a single id, is not split
+        self.assertEqual(exporting.split_ids(None, None, 4), [])
+        self.assertEqual(exporting.split_ids(5, 5, 4), [])
+
+    def test_stitch_parts(self):
+        """ The parts are concatenated in the file and removed
+        """
+        filename = join(self.directory, 'res_partner.csv')
+        for part, data in enumerate(['1,foo\n', '', '2,bar\n3,baz\n']):
+            with open('%s.%s' % (filename, part), 'wb') as f:
+                f.write(data)
+        exporting.stitch_parts(filename, 3)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), '1,foo\n2,bar\n3,baz\n')
+        self.assertFalse(exists(filename + '.0'))
+
+    def test_stitch_binary_parts(self):
+        """ Only the first header and the last trailer of binary parts are kept
+        """
+        filename = join(self.directory, 'res_partner.bin')
+        rows = [[pgbinary.encode_int(i, 4), 'foo%s' % i] for i in range(5)]
+        for part, part_rows in enumerate([rows[:2], [], rows[2:]]):
+            with open('%s.%s' % (filename, part), 'wb') as f:
+                writer = pgbinary.BinaryWriter(f)
+                for row in part_rows:
+                    writer.writerow(row)
+                writer.close()
+        exporting.stitch_parts(filename, 3, binary=True)
+        with open(filename, 'rb') as f:
+            self.assertEqual(list(pgbinary.read_rows(f)), rows)
+            self.assertEqual(f.read(), '')
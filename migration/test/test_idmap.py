@@ -0,0 +1,105 @@
+import pickle
+import shutil
+import tempfile
+import unittest
+from migration import idmap as idmap_module
+from migration.idmap import IdMap, DiskIdMap
+
+
+class TestIdMap(unittest.TestCase):
+
+    """ Tests """
+
+    def check(self, idmap, expected):
+        self.assertEqual(len(idmap), len(expected))
+        self.assertEqual(sorted(idmap.items()), sorted(expected.items()))
+        for key, value in expected.items():
+            self.assertTrue(key in idmap)
+            self.assertEqual(idmap[key], value)
+            self.assertEqual(idmap.get(key, 0), value)
+        self.assertFalse(-1 in idmap)
+        self.assertEqual(idmap.get(-1, 42), 42)
+        self.assertRaises(KeyError, idmap.__getitem__, -1)
+
+    def test_dense(self):
+        """ Dense ids are stored as offsets from the first id
+        """
+        expected = {i: i + 1000 for i in range(1, 100) if i % 7}
+        idmap = IdMap(expected, buffer_size=10)
+        self.assertNotEqual(idmap.base, None)
+        self.check(idmap, expected)
+
+    def test_sparse(self):
+        """ Sparse ids are stored as sorted keys and values
+        """
+        expected = {i * 1000: i for i in range(50, 0, -1)}
+        idmap = IdMap(expected, buffer_size=10)
+        self.assertEqual(idmap.base, None)
+        self.check(idmap, expected)
+
+    def test_update(self):
+        """ Ids are overwritten in the arrays as well as in the buffer
+        """
+        idmap = IdMap(buffer_size=3)
+        expected = {}
+        for key in (5, 1, 3, 8, 2, 5, 1, 900, 3):
+            idmap[key] = expected[key] = key * 10 + len(expected)
+        idmap.update({8: 0, 901: 1})
+        expected.update({8: 0, 901: 1})
+        self.check(idmap, expected)
+        idmap.compact()
+        self.check(idmap, expected)
+
+
+class TestDiskIdMap(TestIdMap):
+
+    """ Tests """
+
+    def setUp(self):
+        super(TestDiskIdMap, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.page_size = idmap_module.PAGE_SIZE
+        idmap_module.PAGE_SIZE = 4
+
+    def tearDown(self):
+        idmap_module.PAGE_SIZE = self.page_size
+        shutil.rmtree(self.directory)
+        super(TestDiskIdMap, self).tearDown()
+
+    def test_dense(self):
+        """ Ids are found in every page of the file
+        """
+        expected = {i: i + 1000 for i in range(1, 100) if i % 7}
+        self.check(DiskIdMap(self.directory, expected, buffer_size=10), expected)
+
+    def test_sparse(self):
+        """ Ids are read through a page cache smaller than the file
+        """
+        expected = {i * 1000: i for i in range(50, 0, -1)}
+        capacity = idmap_module.CACHE.capacity
+        idmap_module.CACHE.capacity = 2
+        try:
+            self.check(DiskIdMap(self.directory, expected, buffer_size=10), expected)
+        finally:
+            idmap_module.CACHE.capacity = capacity
+
+    def test_update(self):
+        """ Ids of the file are overridden by the buffer, then merged in a new file
+        """
+        idmap = DiskIdMap(self.directory, buffer_size=3)
+        expected = {}
+        for key in (5, 1, 3, 8, 2, 5, 1, 900, 3):
+            idmap[key] = expected[key] = key * 10 + len(expected)
+        idmap.update({8: 0, 901: 1})
+        expected.update({8: 0, 901: 1})
+        self.check(idmap, expected)
+        idmap.compact()
+        self.check(idmap, expected)
+
+    def test_pickle(self):
+        """ A pickled map is stored in its file
+        """
+        expected = {i: -i for i in range(20)}
+        idmap = pickle.loads(pickle.dumps(DiskIdMap(self.directory, expected)))
+        self.assertEqual(idmap.buffer, {})
+        self.check(idmap, expected)
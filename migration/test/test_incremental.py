@@ -0,0 +1,62 @@
+import cPickle as pickle
+import shutil
+import unittest
+from tempfile import mkdtemp
+from migration import incremental
+from migration.idmap import IdMap, DiskIdMap
+
+
+class FakeMapping(object):
+
+    def __init__(self):
+        self.max_target_id, self.new_id, self.id_ranges = {}, {}, {}
+
+
+class FakeProcessor(object):
+
+    def __init__(self, fk_mapping=None):
+        self.mapping = FakeMapping()
+        self.fk_mapping = fk_mapping or {}
+        self.is_moved, self.ref_mapping = {}, {}
+
+    def new_id_map(self):
+        return IdMap()
+
+
+class TestIncremental(unittest.TestCase):
+
+    """ Tests """
+
+    def setUp(self):
+        super(TestIncremental, self).setUp()
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestIncremental, self).tearDown()
+
+    def test_dump_state(self):
+        """ The DiskIdMaps are frozen, the dicts and IdMaps pickled as they are
+        """
+        disk_ids = DiskIdMap(self.directory, [(1, 1001), (2, 1002)])
+        processor = FakeProcessor({'res_partner_address': disk_ids,
+                                   'res_users': {3: 1003},
+                                   'res_company': IdMap([(4, 1004)])})
+        processor.mapping.max_target_id = {'res_partner': 1000}
+        processor.mapping.id_ranges = {'res_partner': [(200, 800)]}
+        processor.is_moved = {'res_partner_address': 'res_partner'}
+        state = pickle.loads(pickle.dumps(
+            incremental.dump_state(processor, self.directory), pickle.HIGHEST_PROTOCOL))
+        disk_ids.close()
+        resumed = FakeProcessor()
+        incremental.resume_state(resumed, state)
+        self.assertEqual(sorted(resumed.fk_mapping['res_partner_address'].items()),
+                         [(1, 1001), (2, 1002)])
+        self.assertEqual(resumed.fk_mapping['res_users'].items(), [(3, 1003)])
+        self.assertEqual(resumed.fk_mapping['res_company'].items(), [(4, 1004)])
+        self.assertEqual(resumed.mapping.max_target_id, {'res_partner': 1000})
+        self.assertEqual(resumed.mapping.id_ranges, {'res_partner': [(200, 800)]})
+        self.assertEqual(resumed.is_moved, {'res_partner_address': 'res_partner'})
+        for ids in state['fk_mapping'].values():
+            if isinstance(ids, DiskIdMap):
+                ids.close()
@@ -0,0 +1,44 @@
+import unittest
+from datetime import date, datetime
+from StringIO import StringIO
+from migration import pgbinary
+
+
+class TestPgBinary(unittest.TestCase):
+
+    """ Tests """
+
+    def test_rows(self):
+        """ Rows written in the binary COPY format are read back unchanged
+        """
+        f = StringIO()
+        writer = pgbinary.BinaryWriter(f)
+        rows = [[pgbinary.encode_int(1, 4), 'foo', None],
+                [pgbinary.encode_int(2, 4), '', 'bar']]
+        for row in rows:
+            writer.writerow(row)
+        writer.close()
+        f.seek(0)
+        self.assertEqual(list(pgbinary.read_rows(f)), rows)
+
+    def test_values(self):
+        """ Decoding an encoded value gives the original value
+        """
+        for oid, value in [(pgbinary.INT2, -2), (pgbinary.INT4, 2 ** 31 - 1),
+                           (pgbinary.INT8, 2 ** 40), (pgbinary.BOOL, False),
+                           (pgbinary.FLOAT8, 1.5), (pgbinary.VARCHAR, u'\xe9t\xe9'),
+                           (pgbinary.DATE, date(1999, 12, 31)),
+                           (pgbinary.TIMESTAMP, datetime(2013, 12, 31, 23, 59, 59, 1))]:
+            self.assertEqual(pgbinary.decode(oid, pgbinary.encode(oid, value)), value)
+        self.assertEqual(pgbinary.decode_int(pgbinary.encode_int(-5, 8)), -5)
+
+    def test_invalid(self):
+        """ Data without the binary COPY signature is rejected
+        """
+        self.assertRaises(ValueError, list, pgbinary.read_rows(StringIO('id,name\n')))
+
+    def test_overflow(self):
+        """ An integer too big for its size is rejected
+        """
+        self.assertRaises(ValueError, pgbinary.encode_int, 2 ** 31, 4)
+        self.assertRaises(ValueError, pgbinary.encode_int, -2 ** 15 - 1, 2)
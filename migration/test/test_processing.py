@@ -0,0 +1,49 @@
+import unittest
+import shutil
+from os.path import join, exists
+from tempfile import mkdtemp
+from migration import processing
+
+
+class TestProcessing(unittest.TestCase):
+
+    """ Tests """
+
+    def setUp(self):
+        super(TestProcessing, self).setUp()
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestProcessing, self).tearDown()
+
+    def test_split_deferred(self):
+        """ The rows only updating deferred columns are moved to a narrow file
+        """
+        filepath = join(self.directory, 'res_users.update2.csv')
+        with open(filepath, 'wb') as f:
+            f.write('id,name,create_uid,write_uid\n'
+                    '1,Admin,2,\n'
+                    '2,,3,4\n'
+                    '3,Demo,,\n'
+                    '4,,,5\n')
+        moved = processing.split_deferred(filepath, set(['create_uid', 'write_uid']), 'id')
+        self.assertEqual(moved, 2)
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), 'id,name,create_uid,write_uid\r\n'
+                                       '1,Admin,2,\r\n'
+                                       '3,Demo,,\r\n')
+        with open(join(self.directory, 'res_users.deferred2.csv'), 'rb') as f:
+            self.assertEqual(f.read(), 'id,create_uid,write_uid\r\n'
+                                       '2,3,4\r\n'
+                                       '4,,5\r\n')
+
+    def test_split_deferred_nothing(self):
+        """ Without rows only updating deferred columns, no file is written
+        """
+        filepath = join(self.directory, 'res_users.update2.csv')
+        with open(filepath, 'wb') as f:
+            f.write('id,name,create_uid\n'
+                    '1,Admin,2\n')
+        self.assertEqual(processing.split_deferred(filepath, set(['create_uid']), 'id'), 0)
+        self.assertFalse(exists(join(self.directory, 'res_users.deferred2.csv')))